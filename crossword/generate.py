@@ -1,4 +1,5 @@
 import sys
+from collections import deque
 from copy import deepcopy
 from crossword import *
 
@@ -15,6 +16,15 @@ class CrosswordCreator():
             for var in self.crossword.variables
         }
 
+        # Number of arcs `revise` has checked, and of values it removed
+        self.revisions = 0
+        self.pruned = 0
+
+        # Letter-position index of each variable's domain, built on demand
+        # by `letter_index`: the domain it indexes, and for each position
+        # in the word a dict mapping each letter to the words with it there
+        self.index = dict()
+
     def letter_grid(self, assignment):
         """
         Return 2D array representing a given assignment.
@@ -90,7 +100,8 @@ class CrosswordCreator():
         Enforce node and arc consistency, and then solve the CSP.
         """
         self.enforce_node_consistency()
-        self.ac3()
+        if not self.ac3():
+            return None
         return self.backtrack(dict())
 
     def enforce_node_consistency(self):
@@ -118,24 +129,58 @@ class CrosswordCreator():
         False if no revision was made.
         """
 
-        revised = False
-        overx, overy = self.crossword.overlaps[x, y]
-
-        if overx:
-
-            for a in self.domains[x]:
-                found = False
-
-                for b in self.domains[y]:
-                    if a[overx] == b[overy]:
-                        found = True
-            if not found:
-                self.domains[x].remove(a)
-                revised = True
+        self.revisions += 1
+        overlap = self.crossword.overlaps[x, y]
+        if overlap is None:
+            return False
+        overx, overy = overlap
+
+        # Remove the words of `x` with a letter no word of `y` has there
+        letters_x = self.letter_index(x)[overx]
+        letters_y = self.letter_index(y)[overy]
+        remove = set()
+        for letter, words in letters_x.items():
+            if letter not in letters_y:
+                remove.update(words)
+        if remove:
+            self.remove_words(x, remove)
+            self.pruned += len(remove)
+
+        return len(remove) > 0
+
+    def letter_index(self, var):
+        """
+        Return the letter-position index of the domain of `var`: a list
+        with, for each position in its words, a dict mapping each letter
+        to the set of words in the domain with that letter there.
 
-        return revised
+        The index is kept up to date by `remove_words`, and rebuilt if
+        `self.domains[var]` has been replaced or resized since.
+        """
+        domain = self.domains[var]
+        entry = self.index.get(var)
+        if entry is None or entry[0] is not domain or entry[1] != len(domain):
+            positions = [dict() for _ in range(var.length)]
+            for word in domain:
+                for letters, letter in zip(positions, word):
+                    letters.setdefault(letter, set()).add(word)
+            entry = self.index[var] = [domain, len(domain), positions]
+        return entry[2]
+
+    def remove_words(self, var, words):
+        """
+        Remove `words` from the domain of `var`, and from its index.
+        """
+        positions = self.letter_index(var)
+        self.domains[var].difference_update(words)
+        for word in words:
+            for letters, letter in zip(positions, word):
+                matches = letters[letter]
+                matches.discard(word)
+                if not matches:
+                    del letters[letter]
+        self.index[var][1] = len(self.domains[var])
 
-                             
     def ac3(self, arcs=None):
         """
         Update `self.domains` such that each variable is arc consistent.
@@ -146,25 +191,35 @@ class CrosswordCreator():
         return False if one or more domains end up empty.
         """
 
-        if arcs == None:
-            #  If `arcs` is None, begin with initial list of all arcs in the problem.
-            queue = []
-            for v1 in self.domains:
-                for v2 in self.crossword.neighbors(v1):
-                    if self.crossword.overlaps[v1, v2] != None:
-                        queue.append((v1, v2))
-
-        while len(queue) > 0:
-            # Otherwise, use `arcs` as the initial list of arcs to make consistent.
-            # pop first value in queue and apply ac3
-            i, j = queue.pop(0)
-            if self.revise(i, j):
-                if len(self.domains[i]) == 0:
+        if arcs is None:
+            arcs = [
+                (x, y)
+                for x in self.crossword.variables
+                for y in self.crossword.neighbors(x)
+            ]
+
+        # Arcs wait in a first-in, first-out queue, each at most once
+        queue = deque()
+        queued = set()
+        for arc in arcs:
+            if arc not in queued:
+                queue.append(arc)
+                queued.add(arc)
+
+        while queue:
+            x, y = queue.popleft()
+            queued.remove((x, y))
+            if self.revise(x, y):
+                if not self.domains[x]:
                     return False
-                for each in self.crossword.neighbors(i):
-                    if each != j:
-                        queue.append((each, i))
-            return True
+
+                # Neighbors of `x` may have lost support for their words
+                for z in self.crossword.neighbors(x):
+                    if z != y and (z, x) not in queued:
+                        queue.append((z, x))
+                        queued.add((z, x))
+
+        return True
 
     def assignment_complete(self, assignment):
         """
@@ -220,36 +275,23 @@ class CrosswordCreator():
         that rules out the fewest values among the neighbors of `var`.
         """
 
-        # nearby = all neighbors of var
-        nearby = self.crossword.neighbors(var)
-        
-        for a in assignment:
-            # delete the Variable from nearby if it has already been assigned
-            if a in nearby:
-                nearby.remove(a)
-
-        # we will sort this array by constraints once filled
-        sortedlist = []
-        for s in self.domains[var]:
-            numruleout = 0  # set the number of values the variable rules out to 0 initially
-            for n in nearby:
-                for x in self.domains[n]:
-                    overlap = self.crossword.overlaps[var, n]
-
-
-                    if overlap:
-                        i, j = overlap
-                        # they can be ruled out if overlaps do not equal eachother
-                        if s[i] != x[j]:
-                            numruleout = numruleout + 1
-           
-            sortedlist.append([s, numruleout])
-
-        # sorting the list in order by the number of values they rule out for neighboring variables
-        sortedlist.sort(key = lambda y: y[1])
-
-        # return sortedlist, but remove numruleout in each instance
-        return [final[0] for final in sortedlist] 
+        # nearby = all neighbors of var not already assigned
+        nearby = self.crossword.neighbors(var) - assignment.keys()
+
+        # A value rules out each word of a neighbor without its letter at
+        # their overlap: all the neighbor's words but those indexed by it
+        overlaps = []
+        for n in nearby:
+            i, j = self.crossword.overlaps[var, n]
+            overlaps.append((i, len(self.domains[n]), self.letter_index(n)[j]))
+
+        def ruled_out(value):
+            return sum(
+                size - len(letters.get(value[i], ()))
+                for i, size, letters in overlaps
+            )
+
+        return sorted(self.domains[var], key=ruled_out)
 
 
     def select_unassigned_variable(self, assignment):
@@ -1,4 +1,12 @@
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import json
+import hashlib
 import nltk
+import os
+import pickle
 import sys
 
 # AI to parse sentences and extract noun phrases.
@@ -20,17 +28,61 @@ NONTERMINALS = """
 S -> N V
 """
 
-grammar = nltk.CFG.fromstring(NONTERMINALS + TERMINALS)
-parser = nltk.ChartParser(grammar)
+# Number of sentences sent to a worker process at a time in batch mode
+BATCH_CHUNK_SIZE = 64
+
+# Number of distinct sentences whose parses are cached
+PARSE_CACHE_SIZE = 4096
+
+# Directory compiled grammars are cached in, keyed by a hash of their text
+GRAMMAR_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__")
+
+# Version of the CompiledGrammar state saved in the cache; bump it whenever
+# that state changes, so grammars compiled by older code are not loaded
+GRAMMAR_FORMAT = 1
+
+# Whether `preprocess` prints each sentence and its tokens, to standard
+# error so traces never mix with batch output
+verbose = False
+
+# Grammar compiled for parsing and cache of parses, built on first use
+# by `get_parser`
+parser = None
+cache = None
 
 
 def main():
+    global verbose
+
+    # Check command-line arguments
+    arguments = argparse.ArgumentParser(usage="python parser.py [sentence.txt]")
+    arguments.add_argument("file", nargs="?")
+    arguments.add_argument(
+        "--batch", metavar="CORPUS",
+        help="parse every sentence in this file (one per line, or JSON "
+             "lines with a \"sentence\" field; - for stdin) and print "
+             "their noun phrase chunks as JSON lines"
+    )
+    arguments.add_argument(
+        "--workers", type=int, default=None,
+        help="number of processes to parse batches with"
+    )
+    arguments.add_argument(
+        "--verbose", action="store_true",
+        help="print each sentence and its tokens while preprocessing, to "
+             "standard error"
+    )
+    args = arguments.parse_args()
+    verbose = args.verbose
 
+    # Parse a whole corpus across processes
+    if args.batch:
+        parse_batch(args.batch, workers=args.workers)
+        return
 
-    
     # If filename specified, read sentence from file
-    if len(sys.argv) == 2:
-        with open(sys.argv[1]) as f:
+    if args.file:
+        with open(args.file) as f:
             s = f.read()
 
     # Otherwise, get sentence as input
@@ -42,16 +94,16 @@ def main():
 
     # Attempt to parse sentence
     try:
-        trees = list(parser.parse(s))
+        forest = get_parser().parse(s)
     except ValueError as e:
         print(e)
         return
-    if not trees:
+    if forest is None:
         print("Could not parse sentence.")
         return
 
     # Print each tree with noun phrase chunks
-    for tree in trees:
+    for tree in forest.trees():
         tree.pretty_print()
 
         print("Noun Phrase Chunks")
@@ -67,12 +119,13 @@ def preprocess(sentence):
     character.
     """
 
-
-    print(f'Sentence: {sentence}')
+    if verbose:
+        print(f'Sentence: {sentence}', file=sys.stderr, flush=True)
     tokens = nltk.word_tokenize(sentence)
     tokens = [word.lower() for word in tokens]
-    print(f'Tokens: {tokens}')
-    
+    if verbose:
+        print(f'Tokens: {tokens}', file=sys.stderr, flush=True)
+
     lowercase = ['a','b','c','d','e','f','g','h','i','j','k','l','m','n','o','p','q','r','s','t','u','v','w','x','y','z']
     new = []
 
@@ -84,7 +137,8 @@ def preprocess(sentence):
             else:
                 continue
 
-    print(f'new tokens: {new}')
+    if verbose:
+        print(f'new tokens: {new}', file=sys.stderr, flush=True)
     return new
 
 def np_chunk(tree):
@@ -95,11 +149,538 @@ def np_chunk(tree):
     noun phrases as subtrees.
     """
     NP = []
-    for i in tree.subtrees():
-        if (i.label() == 'NP'):
-            NP.append(i)
+
+    # Visit children before parents, returning whether a subtree holds an NP
+    def visit(subtree):
+        nested = False
+        for child in subtree:
+            if isinstance(child, nltk.Tree) and visit(child):
+                nested = True
+        if subtree.label() == 'NP':
+            if not nested:
+                NP.append(subtree)
+            return True
+        return nested
+
+    visit(tree)
     return NP
 
 
+def get_parser():
+    """
+    Return the compiled grammar, loading it on first use from the grammar
+    cache, or compiling it and saving it there if it is not cached yet.
+    """
+    global parser
+    if parser is None:
+        text = NONTERMINALS + TERMINALS
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        path = os.path.join(
+            GRAMMAR_CACHE, f"grammar-v{GRAMMAR_FORMAT}-{digest}.pickle"
+        )
+
+        # Any cache file that can't be loaded is compiled over again
+        try:
+            parser = CompiledGrammar.load(path)
+        except Exception:
+            parser = CompiledGrammar(nltk.CFG.fromstring(text))
+            try:
+                os.makedirs(GRAMMAR_CACHE, exist_ok=True)
+                parser.save(path)
+            except OSError:
+                pass
+    return parser
+
+
+def get_cache():
+    """
+    Return the cache of parses made with the compiled grammar.
+    """
+    global cache
+    if cache is None or cache.compiled is not get_parser():
+        cache = ParseCache(get_parser(), PARSE_CACHE_SIZE)
+    return cache
+
+
+def parse_batch(path, workers=None):
+    """
+    Parse every sentence in the file `path` (or standard input if `path`
+    is "-") across a pool of `workers` processes, and print one JSON line
+    per sentence with its noun phrase chunks, in input order.
+
+    Each line holds a sentence, or a JSON object with a "sentence" field;
+    lines that are neither get an "error" line in the output instead.
+    The compiled grammar is sent to each worker once, when it starts.
+    """
+    workers = workers or os.cpu_count()
+    f = sys.stdin if path == "-" else open(path)
+    lines = (line for line in f if line.strip())
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=set_parser,
+            initargs=(get_parser(), verbose)
+        ) as executor:
+            window = BATCH_CHUNK_SIZE * workers * 4
+            while True:
+                block = list(itertools.islice(lines, window))
+                if not block:
+                    break
+                for result in executor.map(
+                    parse_line, block, chunksize=BATCH_CHUNK_SIZE
+                ):
+                    print(json.dumps(result))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def read_sentence(line):
+    """
+    Return the sentence on a line of a batch corpus: the "sentence" field
+    of a JSON object, or otherwise the line itself.
+    """
+    line = line.strip()
+    if line.startswith("{"):
+        sentence = json.loads(line).get("sentence")
+        if not isinstance(sentence, str):
+            raise ValueError('JSON line has no "sentence" string.')
+        return sentence
+    return line
+
+
+def parse_line(line):
+    """
+    Parse the sentence on a line of a batch corpus as `parse_sentence`
+    does, or return an "error" for the line if it holds no sentence.
+    """
+    try:
+        sentence = read_sentence(line)
+    except (ValueError, AttributeError) as e:
+        return {"line": line.strip(), "error": f"Invalid input line: {e}"}
+    return parse_sentence(sentence)
+
+
+def set_parser(compiled, trace=False):
+    """
+    Use the already compiled grammar `compiled` in this worker process, and
+    print preprocessing traces if `trace` is True.
+    """
+    global parser, verbose
+    parser = compiled
+    verbose = trace
+
+
+def parse_sentence(sentence):
+    """
+    Parse `sentence` and return a dictionary with the sentence, the number
+    of trees it has, and the distinct noun phrase chunks across all of
+    them in sentence order, or an "error" if it cannot be parsed.
+    """
+    tokens = tuple(preprocess(sentence))
+    try:
+        forest = get_cache().parse(tokens)
+    except ValueError as e:
+        return {"sentence": sentence, "error": str(e)}
+    if forest is None:
+        return {"sentence": sentence, "error": "Could not parse sentence."}
+    return {
+        "sentence": sentence,
+        "trees": forest.count(),
+        "chunks": get_cache().chunks(tokens)
+    }
+
+
+class CompiledGrammar():
+    """
+    A context-free grammar compiled once for CYK parsing.
+
+    Rules are converted to Chomsky normal form, extended with unary rules:
+    right-hand sides longer than two symbols are binarized through hidden
+    intermediate symbols, and terminals inside longer right-hand sides get
+    hidden preterminals. Hidden symbols are spliced back out of trees, so
+    trees read exactly as they would under the original grammar.
+
+    Every nonterminal is a bit position, so each chart cell holds the set
+    of nonterminals spanning it as one integer bitset, and combining two
+    cells and closing the result under unary rules are bitwise operations.
+    """
+
+    def __init__(self, grammar):
+        self.start = grammar.start().symbol()
+        self.symbols = []
+        self.ids = dict()
+        self.hidden = []
+
+        # Maps words to the bitset of symbols with a rule producing them
+        self.lexicon = dict()
+
+        # Maps parents to lists of their unary children, and parents to
+        # lists of (left, right) pairs of their binary children
+        self.unary = collections.defaultdict(list)
+        self.binary = collections.defaultdict(list)
+
+        for production in grammar.productions():
+            parent = self.symbol(production.lhs().symbol())
+            rhs = [
+                self.symbol(s.symbol()) if nltk.grammar.is_nonterminal(s)
+                else s for s in production.rhs()
+            ]
+            if not rhs:
+                raise ValueError(f"Empty production not supported: {production}")
+            if len(rhs) == 1:
+                if isinstance(rhs[0], str):
+                    self.lexicon[rhs[0]] = self.lexicon.get(rhs[0], 0) | 1 << parent
+                else:
+                    self.unary[parent].append(rhs[0])
+                continue
+
+            # Give terminals hidden preterminals, then binarize
+            for i, s in enumerate(rhs):
+                if isinstance(s, str):
+                    rhs[i] = self.symbol(f'"{s}"', hidden=True)
+                    self.lexicon[s] = self.lexicon.get(s, 0) | 1 << rhs[i]
+            while len(rhs) > 2:
+                rest = self.symbol(
+                    f"{self.symbols[parent]}|{len(self.symbols)}", hidden=True
+                )
+                self.binary[parent].append((rhs[0], rest))
+                parent, rhs = rest, rhs[1:]
+            self.binary[parent].append(tuple(rhs))
+
+        # Maps each left child to the bitset of right children it pairs
+        # with, and each (left, right) pair to the bitset of their parents
+        self.right_children = collections.defaultdict(int)
+        self.parents = collections.defaultdict(int)
+        for parent, pairs in self.binary.items():
+            for left, right in pairs:
+                self.right_children[left] |= 1 << right
+                self.parents[left, right] |= 1 << parent
+
+        # Maps each symbol to the bitset of symbols deriving it through
+        # zero or more unary rules
+        self.ancestors = [1 << s for s in range(len(self.symbols))]
+        for s in range(len(self.symbols)):
+            self.ancestors[s] = self.unary_ancestors(s)
+        self.closures = dict()
+
+    def symbol(self, name, hidden=False):
+        """
+        Return the bit position of the symbol `name`, adding it if new.
+        """
+        if name not in self.ids:
+            self.ids[name] = len(self.symbols)
+            self.symbols.append(name)
+            self.hidden.append(hidden)
+        return self.ids[name]
+
+    def unary_ancestors(self, symbol):
+        """
+        Return the bitset of symbols deriving `symbol` through unary rules.
+        """
+        found = 1 << symbol
+        frontier = [symbol]
+        while frontier:
+            child = frontier.pop()
+            for parent, children in self.unary.items():
+                if child in children:
+                    if parent == symbol:
+                        raise ValueError(
+                            f"Cyclic unary rules through {self.symbols[symbol]}"
+                        )
+                    if not found >> parent & 1:
+                        found |= 1 << parent
+                        frontier.append(parent)
+        return found
+
+    def closure(self, symbols):
+        """
+        Return bitset `symbols` closed under unary rules.
+        """
+        if symbols not in self.closures:
+            closed = 0
+            for s in bits(symbols):
+                closed |= self.ancestors[s]
+            self.closures[symbols] = closed
+        return self.closures[symbols]
+
+    def chart(self, tokens, prefix=None):
+        """
+        Return the CYK chart for `tokens`, as a list of columns:
+        `chart[j][i]` is the bitset of symbols that derive `tokens[i:j]`.
+
+        Cells are filled column by column, so if `prefix` is the chart of
+        a prefix of `tokens`, only the columns past it are computed.
+        """
+        missing = [t for t in tokens if t not in self.lexicon]
+        if missing:
+            raise ValueError(
+                "Grammar does not cover some of the input words: "
+                + ", ".join(repr(t) for t in missing) + "."
+            )
+
+        chart = list(prefix) if prefix else [[]]
+        for j in range(len(chart), len(tokens) + 1):
+            column = [0] * j
+            column[j - 1] = self.closure(self.lexicon[tokens[j - 1]])
+            for i in range(j - 2, -1, -1):
+                found = 0
+                for k in range(i + 1, j):
+                    right = column[k]
+                    if not right:
+                        continue
+                    for left in bits(chart[k][i]):
+                        for r in bits(right & self.right_children.get(left, 0)):
+                            found |= self.parents[left, r]
+                column[i] = self.closure(found) if found else 0
+            chart.append(column)
+        return chart
+
+    def parse(self, tokens, chart=None):
+        """
+        Parse the list of words `tokens`, given its `chart` if already
+        computed. Return a `ParseForest` of every parse, or None if the
+        sentence cannot be parsed.
+        """
+        tokens = list(tokens)
+        if chart is None:
+            chart = self.chart(tokens)
+        start = self.ids[self.start]
+        if not tokens or not chart[len(tokens)][0] >> start & 1:
+            return None
+        return ParseForest(self, tokens, chart)
+
+    def save(self, path):
+        """
+        Save the compiled grammar to the file `path`, atomically.
+        """
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            pickle.dump(
+                {"format": GRAMMAR_FORMAT, "state": self.__dict__}, f,
+                protocol=pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a grammar previously written with `save` from the file `path`.
+        Raise ValueError if it was saved in another GRAMMAR_FORMAT.
+        """
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+        if not isinstance(saved, dict) or saved.get("format") != GRAMMAR_FORMAT:
+            raise ValueError(f"{path} is not a format {GRAMMAR_FORMAT} grammar")
+        compiled = cls.__new__(cls)
+        compiled.__dict__.update(saved["state"])
+        return compiled
+
+
+class ParseCache():
+    """
+    LRU cache of the charts, parse forests and noun phrase chunks of the
+    last `size` distinct sentences, keyed by their preprocessed tokens.
+
+    A new sentence that extends a cached one reuses its chart, so only the
+    chart columns for the new words are computed.
+    """
+
+    def __init__(self, compiled, size):
+        self.compiled = compiled
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def entry(self, tokens):
+        """
+        Return the cache entry for the tuple `tokens`, computing its chart
+        if it is not cached, and mark it as most recently used.
+        """
+        if tokens in self.entries:
+            self.entries.move_to_end(tokens)
+            return self.entries[tokens]
+
+        prefix = None
+        for end in range(len(tokens) - 1, 0, -1):
+            if tokens[:end] in self.entries:
+                prefix = self.entries[tokens[:end]]["chart"]
+                break
+        entry = {"chart": self.compiled.chart(tokens, prefix)}
+        self.entries[tokens] = entry
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return entry
+
+    def parse(self, tokens):
+        """
+        Return the `ParseForest` of the tuple `tokens`, or None.
+        """
+        entry = self.entry(tokens)
+        if "forest" not in entry:
+            entry["forest"] = self.compiled.parse(tokens, entry["chart"])
+        return entry["forest"]
+
+    def chunks(self, tokens):
+        """
+        Return the list of distinct noun phrase chunks, as strings, across
+        every parse of the tuple `tokens`, or None if it cannot be parsed.
+        """
+        entry = self.entry(tokens)
+        if "chunks" not in entry:
+            forest = self.parse(tokens)
+            if forest is None:
+                entry["chunks"] = None
+            else:
+                entry["chunks"] = [
+                    " ".join(tokens[i:j]) for i, j in forest.np_chunks()
+                ]
+        return entry["chunks"]
+
+
+class ParseForest():
+    """
+    Packed forest of every parse of a sentence. Each item `(i, j, symbol)`
+    maps to its alternative derivations: `("word",)` for a word, `("unary",
+    child)`, or `("binary", k, left, right)` for children split at `k`.
+    Only items reachable from the root are kept, so the forest has at most
+    a polynomial number of items however many trees it packs.
+    """
+
+    def __init__(self, grammar, tokens, chart):
+        self.grammar = grammar
+        self.tokens = tokens
+        self.root = (0, len(tokens), grammar.ids[grammar.start])
+        self.items = dict()
+
+        pending = [self.root]
+        while pending:
+            item = pending.pop()
+            if item in self.items:
+                continue
+            i, j, symbol = item
+            alternatives = []
+            if j == i + 1 and grammar.lexicon[tokens[i]] >> symbol & 1:
+                alternatives.append(("word",))
+            for child in grammar.unary.get(symbol, ()):
+                if chart[j][i] >> child & 1:
+                    alternatives.append(("unary", child))
+                    pending.append((i, j, child))
+            for left, right in grammar.binary.get(symbol, ()):
+                for k in range(i + 1, j):
+                    if chart[k][i] >> left & 1 and chart[j][k] >> right & 1:
+                        alternatives.append(("binary", k, left, right))
+                        pending.append((i, k, left))
+                        pending.append((k, j, right))
+            self.items[item] = alternatives
+
+    def label(self, symbol):
+        return self.grammar.symbols[symbol]
+
+    def count(self):
+        """
+        Return the number of trees in the forest, without enumerating them.
+        """
+        counts = dict()
+
+        def count(item):
+            if item not in counts:
+                i, j, _ = item
+                total = 0
+                for alternative in self.items[item]:
+                    if alternative[0] == "word":
+                        total += 1
+                    elif alternative[0] == "unary":
+                        total += count((i, j, alternative[1]))
+                    else:
+                        _, k, left, right = alternative
+                        total += count((i, k, left)) * count((k, j, right))
+                counts[item] = total
+            return counts[item]
+
+        return count(self.root)
+
+    def np_chunks(self, label="NP"):
+        """
+        Return a sorted list of the spans `(i, j)` of the noun phrase chunks
+        (by `label`) in any tree of the forest: spans of NPs that, in at
+        least one of their derivations, contain no other NP.
+
+        Whether an item can be derived without an NP is memoized per item,
+        so this takes time polynomial in the sentence length however many
+        trees the forest packs.
+        """
+        target = self.grammar.ids.get(label)
+        free = dict()
+
+        # Whether `item` has a derivation with no NP inside it
+        def derivable_without(item):
+            if item not in free:
+                i, j, _ = item
+                free[item] = False
+                for alternative in self.items[item]:
+                    if alternative[0] == "word":
+                        children = []
+                    elif alternative[0] == "unary":
+                        children = [(i, j, alternative[1])]
+                    else:
+                        _, k, left, right = alternative
+                        children = [(i, k, left), (k, j, right)]
+                    if all(
+                        child[2] != target and derivable_without(child)
+                        for child in children
+                    ):
+                        free[item] = True
+                        break
+            return free[item]
+
+        return sorted(
+            (i, j) for i, j, symbol in self.items
+            if symbol == target and derivable_without((i, j, symbol))
+        )
+
+    def trees(self):
+        """
+        Lazily yield every parse tree in the forest as an `nltk.Tree`.
+        """
+        for children in self.expand(self.root):
+            yield children[0]
+
+    def expand(self, item):
+        """
+        Yield, for each derivation of `item`, the list of nodes it adds to
+        its parent: a single tree, or the children of a hidden symbol.
+        """
+        i, j, symbol = item
+        for alternative in self.items[item]:
+            for children in self.children(i, j, alternative):
+                if self.grammar.hidden[symbol]:
+                    yield children
+                else:
+                    yield [nltk.Tree(self.label(symbol), children)]
+
+    def children(self, i, j, alternative):
+        """
+        Yield each list of child nodes of one `alternative` over `i:j`.
+        """
+        if alternative[0] == "word":
+            yield [self.tokens[i]]
+        elif alternative[0] == "unary":
+            yield from self.expand((i, j, alternative[1]))
+        else:
+            _, k, left, right = alternative
+            for first in self.expand((i, k, left)):
+                for second in self.expand((k, j, right)):
+                    yield first + second
+
+
+def bits(bitset):
+    """
+    Yield the positions of the bits set in the integer `bitset`.
+    """
+    while bitset:
+        low = bitset & -bitset
+        yield low.bit_length() - 1
+        bitset ^= low
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,53 +1,134 @@
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import json
 import nltk
+import numpy as np
 import sys
 import os
 import math
+import pickle
 import string
+import time
+
+from scipy import sparse
 
 
 FILE_MATCHES = 1
 SENTENCE_MATCHES = 1
+QUERY_BATCH_SIZE = 512
+CORPUS_CHUNK_SIZE = 32
+
+# BM25 term frequency saturation and document length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+TOKEN_CACHE_SIZE = 4096
 
 # AI to answer queries
 
 def main():
 
     # Check command-line arguments
-    if len(sys.argv) != 2:
-        sys.exit("Usage: python questions.py corpus")
-
-    # Calculate IDF values across files
-    files = load_files(sys.argv[1])
-    file_words = {
-        filename: tokenize(files[filename])
-        for filename in files
-    }
-    file_idfs = compute_idfs(file_words)
+    parser = argparse.ArgumentParser(description="AI to answer queries")
+    parser.add_argument("corpus")
+    parser.add_argument(
+        "--index",
+        help="file to load the inverted index from, or save it to once built"
+    )
+    parser.add_argument(
+        "--sentences",
+        help="directory of the precomputed sentence store, refreshed on start"
+    )
+    parser.add_argument(
+        "--build", action="store_true",
+        help="only build the index and sentence store, then exit"
+    )
+    parser.add_argument(
+        "--batch",
+        help="answer every query in this file (one per line, - for stdin) "
+             "and print the answers as JSON lines; requires --sentences"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(),
+        help="number of processes to tokenize the corpus with"
+    )
+    parser.add_argument(
+        "--ranking", choices=["tfidf", "bm25"], default="tfidf",
+        help="how to rank files for interactive queries"
+    )
+    args = parser.parse_args()
+    if args.batch and not args.sentences:
+        parser.error("--batch requires --sentences")
+
+    # Share one tokenizer pipeline between files, sentences and queries
+    tokenizer = Tokenizer(cache_size=TOKEN_CACHE_SIZE)
+
+    # Segment and tokenize sentences of new or changed files ahead of time
+    store = None
+    if args.sentences:
+        store = SentenceStore.build(args.sentences, args.corpus, tokenizer)
+
+    # Answer queries in bulk with sparse matrix products
+    if args.batch:
+        answer_batch(args.batch, BatchScorer(store), tokenizer)
+        return
+
+    # Build (or reuse) the inverted index over files
+    index = load_index(args.index, args.corpus) if args.index else None
+    if index is None:
+        vocabulary, file_words = load_corpus(args.corpus, workers=args.workers)
+        index = InvertedIndex(
+            file_words, fingerprint=corpus_fingerprint(args.corpus),
+            vocabulary=vocabulary
+        )
+        if args.index:
+            index.save(args.index)
+    if args.build:
+        return
+    file_idfs = index.idfs(args.ranking)
 
     # Prompt user for query
-    query = set(tokenize(input("Query: ")))
+    query = set(tokenizer(input("Query: ")))
 
     # Determine top file matches according to TF-IDF
-    filenames = top_files(query, file_words, file_idfs, n=FILE_MATCHES)
-
-    # Extract sentences from top files
-    sentences = dict()
-    for filename in filenames:
-        for passage in files[filename].split("\n"):
-            for sentence in nltk.sent_tokenize(passage):
-                tokens = tokenize(sentence)
-                if tokens:
-                    sentences[sentence] = tokens
-
-    # Compute IDF values across sentences
-    idfs = compute_idfs(sentences)
-
-    # Determine top sentence matches
-    matches = top_sentences(query, sentences, idfs, n=SENTENCE_MATCHES)
+    filenames = index.top_files(
+        query, file_idfs, n=FILE_MATCHES, ranking=args.ranking
+    )
+
+    # Determine top sentence matches, from the store if there is one
+    if store is not None:
+        matches = store.top_sentences(query, filenames, n=SENTENCE_MATCHES)
+    else:
+        sentences = dict()
+        for filename in filenames:
+            path = os.path.join(args.corpus, filename)
+            with open(path, encoding="utf-8", errors="replace") as f:
+                for sentence in segment(f.read()):
+                    tokens = tokenizer(sentence)
+                    if tokens:
+                        sentences[sentence] = tokens
+
+        # Compute IDF values across sentences
+        sentence_index = InvertedIndex(sentences)
+        idfs = sentence_index.idfs()
+        matches = sentence_index.top_sentences(query, idfs, n=SENTENCE_MATCHES)
+
     for match in matches:
         print(match)
 
 
+def segment(contents):
+    """
+    Yield the sentences of a file's `contents`, passage by passage.
+    """
+    for passage in contents.split("\n"):
+        yield from nltk.sent_tokenize(passage)
+
+
 def load_files(directory):
     """
     Given a directory name, return a dictionary mapping the filename of each
@@ -56,10 +137,69 @@ def load_files(directory):
     # dictionary mapping txt file
     mapping = {}
     for fi in os.listdir(directory):
-        with open(os.path.join(directory, fi)) as f:
+        with open(os.path.join(directory, fi), encoding="utf-8", errors="replace") as f:
             mapping[fi] = f.read()
     return mapping
 
+
+def load_corpus(directory, workers=None):
+    """
+    Tokenize every file in `directory` across a pool of `workers` processes
+    and return a tuple (vocabulary, documents).
+
+    `vocabulary` is a list of words, and `documents` maps each filename to a
+    NumPy array of the positions of its words in `vocabulary`, in order.
+    Files are streamed from disk in chunks of CORPUS_CHUNK_SIZE; each worker
+    interns words into a vocabulary of its own, which is merged into the
+    shared one as its chunk's results arrive.
+    """
+    filenames = sorted(os.listdir(directory))
+    chunks = [
+        [os.path.join(directory, f) for f in filenames[i:i + CORPUS_CHUNK_SIZE]]
+        for i in range(0, len(filenames), CORPUS_CHUNK_SIZE)
+    ]
+
+    if workers == 1 or len(chunks) <= 1:
+        results = map(tokenize_chunk, chunks)
+        executor = None
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(tokenize_chunk, chunks)
+
+    ids = dict()
+    documents = dict()
+    try:
+        for chunk, (words, encoded) in zip(chunks, results):
+            mapping = np.array(
+                [ids.setdefault(w, len(ids)) for w in words], dtype=np.int32
+            )
+            for path, array in zip(chunk, encoded):
+                documents[os.path.basename(path)] = mapping[array]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return list(ids), documents
+
+
+def tokenize_chunk(paths):
+    """
+    Tokenize the files at `paths` and return a tuple (words, encoded), where
+    `encoded` holds an array per file of positions in the list `words`.
+    Runs inside worker processes, each with a tokenizer of its own.
+    """
+    global default_tokenizer
+    if default_tokenizer is None:
+        default_tokenizer = Tokenizer()
+    ids = dict()
+    encoded = []
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            encoded.append(np.fromiter(
+                (ids.setdefault(w, len(ids)) for w in default_tokenizer.stream(f)),
+                dtype=np.int32
+            ))
+    return list(ids), encoded
+
 def tokenize(document):
     """
     Given a document (represented as a string), return a list of all of the
@@ -68,14 +208,68 @@ def tokenize(document):
     Process document by coverting all words to lowercase, and removing any
     punctuation or English stopwords.
     """
-    #tokenize document in lowercase
-    words = nltk.word_tokenize(document.lower())
-    newdocument = []
-    for w in words:
-        # if not a stopword or punctuation
-        if w not in nltk.corpus.stopwords.words("english") and w not in string.punctuation:
-            newdocument.append(w)
-    return newdocument
+    global default_tokenizer
+    if default_tokenizer is None:
+        default_tokenizer = Tokenizer()
+    return default_tokenizer(document)
+
+
+# Tokenizer used by `tokenize`, created on first use
+default_tokenizer = None
+
+
+class Tokenizer():
+    """
+    Reusable tokenizer pipeline. English stopwords are loaded once into a
+    frozenset, and punctuation filtering is precompiled into a frozenset of
+    every token `string.punctuation` contains, so each word is filtered with
+    two constant-time lookups.
+
+    If `cache_size` is given, calling the tokenizer directly goes through an
+    LRU cache of that many documents, for repeated sentences and queries.
+    """
+
+    def __init__(self, cache_size=None):
+        self.stopwords = frozenset(nltk.corpus.stopwords.words("english"))
+        self.punctuation = frozenset(
+            string.punctuation[i:j]
+            for i in range(len(string.punctuation))
+            for j in range(i + 1, len(string.punctuation) + 1)
+        )
+        self.excluded = self.stopwords | self.punctuation
+        if cache_size:
+            self.cached = functools.lru_cache(maxsize=cache_size)(
+                lambda document: tuple(self.words(document))
+            )
+        else:
+            self.cached = None
+
+    def __call__(self, document):
+        """
+        Return the list of words in `document`, using the cache if enabled.
+        """
+        if self.cached is None:
+            return list(self.words(document))
+        return list(self.cached(document))
+
+    def words(self, document):
+        """
+        Yield the words of `document` (a string), lowercased, in order,
+        without punctuation or English stopwords. Always bypasses the cache.
+        """
+        excluded = self.excluded
+        for word in nltk.word_tokenize(document.lower()):
+            if word not in excluded:
+                yield word
+
+    def stream(self, lines):
+        """
+        Yield the words of a document given as an iterable of lines, such as
+        an open file, without ever holding the whole document in memory.
+        """
+        for line in lines:
+            yield from self.words(line)
+
 
 def compute_idfs(documents):
     """
@@ -84,20 +278,34 @@ def compute_idfs(documents):
 
     Any word that appears in at least one of the documents should be in the
     resulting dictionary.
+
+    Each document is reduced to its set of distinct words once, so this is
+    a single pass over the corpus.
     """
-    wordset = set()
-    idfs = dict()
-    numdoc = len(documents)
-    for fi in documents:
-        wordset.update(set(documents[fi]))
+    frequencies = collections.Counter()
+    for filename in documents:
+        frequencies.update(set(documents[filename]))
+    return {
+        word: math.log(len(documents) / frequency)
+        for word, frequency in frequencies.items()
+    }
 
-    for w in wordset:
-        f = sum( w in documents[filename] for filename in documents ) 
-        each = math.log(numdoc / f)
-        idfs[word] = each
 
+def matrix_idfs(matrix):
+    """
+    Given a sparse CSR term-document `matrix`, with one row per document
+    and one column per word, return a NumPy array of the IDF value of
+    each column.
+
+    Columns for words that appear in no document are given an IDF of 0.
+    """
+    frequencies = np.bincount(matrix.indices, minlength=matrix.shape[1])
+    idfs = np.zeros(matrix.shape[1])
+    present = frequencies > 0
+    idfs[present] = np.log(matrix.shape[0] / frequencies[present])
     return idfs
 
+
 def top_files(query, files, idfs, n):
     """
     Given a `query` (a set of words), `files` (a dictionary mapping names of
@@ -106,22 +314,14 @@ def top_files(query, files, idfs, n):
     files that match the query, ranked according to tf-idf.
     """
 
-    matchedfiles = []
-
-    for f in files:
-        tfidf = 0
+    filenames = list(files)
+    scores = np.array([
+        sum(idfs[word] * files[filename].count(word) for word in query)
+        for filename in filenames
+    ], dtype=np.float64)
 
-        for i in query:
-            tfidf = tfidf + idfs[i] * files[f].count(i)
-
-        matchedfiles.append((f, tfidf))
-        # rank according to tfidf
-
-    matchedfiles.sort(key=lambda x: x[1], reverse=True)
-
-
-    return [x[0] for x in matchedfiles[:n]]
-    
+    # rank according to tfidf
+    return [filenames[i] for i in top_indices(scores, n)]
 
 
 def top_sentences(query, sentences, idfs, n):
@@ -132,22 +332,755 @@ def top_sentences(query, sentences, idfs, n):
     the query, ranked according to idf. If there are ties, preference should
     be given to sentences that have a higher query term density.
     """
-    sentencelist = []
-    
-    for s in sentences:
-        idf = 0
-        wordcount = 0
+    texts = list(sentences)
+    scores = np.zeros(len(texts))
+    densities = np.zeros(len(texts))
+
+    for i, s in enumerate(texts):
+        words = set(sentences[s])
+        matched = [word for word in query if word in words]
+        scores[i] = sum(idfs[word] for word in matched)
+        densities[i] = len(matched) / len(sentences[s])
+
+    # rank by idf, then by density, and return only n top sentences
+    return [texts[i] for i in top_indices(scores, n, densities)]
+
+
+def top_indices(scores, n, tiebreaks=None):
+    """
+    Return an array of the indices of the `n` highest `scores`, highest
+    first. Ties are broken by higher `tiebreaks`, if given, then by lower
+    index, like a stable sort would.
+
+    Only the candidates `np.argpartition` selects are ever sorted, rather
+    than every score.
+    """
+    n = min(n, len(scores))
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64)
+    candidates = np.arange(len(scores))
+    if n < len(scores):
+        kth = len(scores) - n
+        threshold = scores[np.argpartition(scores, kth)[kth]]
+        candidates = np.flatnonzero(scores >= threshold)
+    keys = [candidates]
+    if tiebreaks is not None:
+        keys.append(-tiebreaks[candidates])
+    keys.append(-scores[candidates])
+    return candidates[np.lexsort(keys)[:n]]
+
+
+def answer_batch(path, scorer, tokenizer):
+    """
+    Answer every query in the file `path` (one per line, or standard input
+    if `path` is "-") with `scorer`, printing one JSON line per query, and
+    report throughput to standard error.
+    """
+    f = sys.stdin if path == "-" else open(path)
+    count = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            queries = [
+                line.rstrip("\n")
+                for line in itertools.islice(f, QUERY_BATCH_SIZE)
+            ]
+            if not queries:
+                break
+            answers = scorer.answer(
+                [set(tokenizer(query)) for query in queries],
+                FILE_MATCHES, SENTENCE_MATCHES
+            )
+            for query, (filenames, sentences) in zip(queries, answers):
+                print(json.dumps(
+                    {"query": query, "files": filenames, "sentences": sentences}
+                ))
+            count += len(queries)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    elapsed = time.perf_counter() - start
+    print(
+        f"Answered {count} queries in {elapsed:.3f}s "
+        f"({count / elapsed if elapsed else 0:.0f} queries/s)",
+        file=sys.stderr
+    )
+
+
+def corpus_fingerprint(directory):
+    """
+    Return a tuple identifying the current state of every file in
+    `directory`, so a saved index can tell when the corpus has changed.
+    """
+    fingerprint = []
+    for filename in sorted(os.listdir(directory)):
+        stat = os.stat(os.path.join(directory, filename))
+        fingerprint.append((filename, stat.st_size, stat.st_mtime_ns))
+    return tuple(fingerprint)
+
+
+def load_index(path, directory):
+    """
+    Load a saved `InvertedIndex` from `path`. Return None if there is no
+    saved index, or if it was built from a different state of `directory`.
+    """
+    if not os.path.exists(path):
+        return None
+    index = InvertedIndex.load(path)
+    if index.fingerprint != corpus_fingerprint(directory):
+        return None
+    return index
+
+
+class InvertedIndex():
+    """
+    Inverted index over a dictionary mapping document names to lists of
+    words. Each word maps to a posting list of the documents it appears in,
+    together with its precomputed term frequency in each of them, so queries
+    only touch documents containing at least one query word.
+
+    If a `vocabulary` list is given, documents are instead arrays of
+    positions in it, as returned by `load_corpus`.
+    """
+
+    def __init__(self, documents, fingerprint=None, vocabulary=None):
+        self.fingerprint = fingerprint
+        self.documents = []
+        self.lengths = []
+
+        # Maps words to a tuple (document ids, term frequencies), both in
+        # increasing order of document id
+        self.postings = dict()
+
+        for doc_id, name in enumerate(documents):
+            words = documents[name]
+            self.documents.append(name)
+            self.lengths.append(len(words))
+            if vocabulary is None:
+                counts = collections.Counter(words)
+            else:
+                terms, frequencies = np.unique(words, return_counts=True)
+                counts = {
+                    vocabulary[term]: count
+                    for term, count in zip(terms.tolist(), frequencies.tolist())
+                }
+            for word, count in counts.items():
+                if word not in self.postings:
+                    self.postings[word] = ([], [])
+                doc_ids, tfs = self.postings[word]
+                doc_ids.append(doc_id)
+                tfs.append(count)
+
+        # Largest weighted term frequency in each posting list, which bounds
+        # how much a word can add to the score of any document
+        self.average_length = sum(self.lengths) / max(len(self.lengths), 1)
+        self.bounds = {"tfidf": dict(), "bm25": dict()}
+        for word, (doc_ids, tfs) in self.postings.items():
+            self.bounds["tfidf"][word] = max(tfs)
+            self.bounds["bm25"][word] = max(
+                self.bm25_tf(tf, doc_id) for doc_id, tf in zip(doc_ids, tfs)
+            )
+
+    def __len__(self):
+        return len(self.documents)
+
+    def bm25_tf(self, tf, doc_id):
+        """
+        Return the BM25 weight of a term frequency `tf` in document `doc_id`.
+        """
+        norm = 1 - BM25_B + BM25_B * self.lengths[doc_id] / self.average_length
+        return tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+
+    def idfs(self, ranking="tfidf"):
+        """
+        Return a dictionary mapping every indexed word to its IDF value,
+        read directly off the length of its posting list. With the "bm25"
+        `ranking`, use the BM25 form of IDF, which is always positive.
+        """
+        total = len(self.documents)
+        if ranking == "bm25":
+            return {
+                word: math.log(1 + (total - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+                for word, (doc_ids, _) in self.postings.items()
+            }
+        return {
+            word: math.log(total / len(doc_ids))
+            for word, (doc_ids, _) in self.postings.items()
+        }
+
+    def top_files(self, query, idfs, n, ranking="tfidf"):
+        """
+        Return a list of the names of the `n` top documents that match
+        `query` (a set of words), ranked according to tf-idf, or to BM25 if
+        `ranking` is "bm25" (in which case `idfs` should come from
+        `self.idfs("bm25")`).
+
+        Uses WAND dynamic pruning: posting lists are walked in document id
+        order, and any document whose score, bounded by the largest possible
+        contribution of each word it could contain, cannot enter the current
+        top `n` is skipped without being scored.
+        """
+        weight = self.bm25_tf if ranking == "bm25" else lambda tf, doc_id: tf
+        bounds = self.bounds[ranking]
+
+        # Cursors into each posting list: [current position, doc ids, tfs,
+        # idf, upper bound on the word's contribution to any score]
+        cursors = [
+            [0, *self.postings[word], idfs[word], idfs[word] * bounds[word]]
+            for word in query if word in self.postings
+        ]
+
+        # Min-heap of the best (score, -doc id) so far
+        best = []
+        while cursors:
+            cursors.sort(key=lambda c: c[1][c[0]])
+            threshold = best[0][0] if len(best) == n else -math.inf
+
+            # Find the first cursor at which enough upper bound accumulates
+            # for a document to possibly reach the threshold
+            total = 0
+            pivot = None
+            for i, cursor in enumerate(cursors):
+                total += cursor[4]
+                if total >= threshold:
+                    pivot = i
+                    break
+            if pivot is None:
+                break
+            doc_id = cursors[pivot][1][cursors[pivot][0]]
+
+            if cursors[0][1][cursors[0][0]] == doc_id:
+
+                # Every cursor up to the pivot is on the document: score it
+                score = 0
+                for cursor in cursors:
+                    position, doc_ids, tfs, idf, _ = cursor
+                    if doc_ids[position] != doc_id:
+                        break
+                    score += idf * weight(tfs[position], doc_id)
+                    cursor[0] += 1
+                entry = (score, -doc_id)
+                if len(best) < n:
+                    heapq.heappush(best, entry)
+                elif entry > best[0]:
+                    heapq.heapreplace(best, entry)
+            else:
+
+                # Skip cursors before the pivot ahead to the pivot document
+                for cursor in cursors[:pivot]:
+                    cursor[0] = bisect.bisect_left(cursor[1], doc_id, cursor[0])
+
+            cursors = [c for c in cursors if c[0] < len(c[1])]
+
+        best.sort(reverse=True)
+        return [self.documents[-doc_id] for _, doc_id in best]
+
+    def top_sentences(self, query, idfs, n):
+        """
+        Return a list of the `n` top documents (here, sentences) that match
+        `query`, ranked according to the sum of the IDF values of the query
+        words they contain, with ties broken by query term density.
+        """
+        matched = dict()
         for word in query:
-            if word in sentences[s]:
-                wordcount = wordcount + 1
-                idf = idf + idfs[word]
-        density = float(wordcount) / len(sentences[s])
-        sentencelist.append((s, idf, density))
-    # rank by idf
-    sentencelist.sort(key = lambda x: (x[1], x[2]), reverse = True)
-    # return only n top sentences
-    return [x[0] for x in sentencelist[:n]]
+            if word not in self.postings:
+                continue
+            idf = idfs[word]
+            for doc_id in self.postings[word][0]:
+                total, count = matched.get(doc_id, (0, 0))
+                matched[doc_id] = (total + idf, count + 1)
+
+        def rank(doc_id):
+            total, count = matched[doc_id]
+            return (total, count / self.lengths[doc_id], -doc_id)
+
+        best = heapq.nlargest(n, matched, key=rank)
+        return [self.documents[doc_id] for doc_id in best]
+
+    def save(self, path):
+        """
+        Save the index to the file `path`.
+        """
+        with open(path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        """
+        Load an index previously written with `save` from the file `path`.
+        """
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+class SentenceStore():
+    """
+    Precomputed, memory-mapped store of every sentence in a corpus.
+
+    A store is a directory holding a flat array of sentence token ids, the
+    token offsets of each sentence, the UTF-8 text of each sentence and,
+    per file, the number of that file's sentences each word appears in.
+    A manifest records the vocabulary and, for every file, its size,
+    modification time and slices of those arrays. Answering a query then
+    only scores the sentences of the top files: IDF values over any set
+    of files are summed from the stored per-file frequencies.
+
+    Each build writes its arrays under file names of a new generation, and
+    only then replaces the manifest naming that generation, so a store is
+    always read whole from one build.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        self.generation = manifest["generation"]
+        self.files = manifest["files"]
+        self.vocabulary = manifest["vocabulary"]
+        self.ids = {word: i for i, word in enumerate(self.vocabulary)}
+        self.tokens = self.array("tokens")
+        self.offsets = self.array("offsets")
+        self.text = self.array("text")
+        self.text_offsets = self.array("text_offsets")
+        self.frequency_terms = self.array("frequency_terms")
+        self.frequency_counts = self.array("frequency_counts")
+
+    def array(self, name):
+        """
+        Memory-map the array `name` of the store.
+        """
+        return np.load(
+            os.path.join(self.path, f"{name}-{self.generation}.npy"), mmap_mode="r"
+        )
+
+    def sentence(self, i):
+        """
+        Return the text of sentence number `i`.
+        """
+        start, end = self.text_offsets[i], self.text_offsets[i + 1]
+        return bytes(self.text[start:end]).decode("utf-8")
+
+    def unchanged(self, directory):
+        """
+        Return True if the files in `directory` are exactly those the store
+        was built from, with the same sizes and modification times.
+        """
+        filenames = sorted(os.listdir(directory))
+        if filenames != sorted(self.files):
+            return False
+        for filename in filenames:
+            stat = os.stat(os.path.join(directory, filename))
+            entry = self.files[filename]
+            if (entry["size"] != stat.st_size or
+                    entry["mtime_ns"] != stat.st_mtime_ns):
+                return False
+        return True
+
+    @classmethod
+    def build(cls, path, directory, tokenizer):
+        """
+        Build the store at `path` for the files in `directory` and return
+        it. If a store already exists there, it is returned as it is when
+        no file changed; otherwise only files whose size or modification
+        time changed are segmented and tokenized again, and the arrays of
+        all other files are copied over, their token ids remapped.
+        """
+        old = None
+        try:
+            old = cls(path)
+        except (OSError, ValueError, KeyError):
+            pass
+        if old is not None and old.unchanged(directory):
+            return old
+
+        # Maps ids in the old vocabulary to ids in the new one, or -1
+        ids = dict()
+        remap = np.full(len(old.vocabulary) if old else 0, -1, dtype=np.int32)
+
+        files = dict()
+        tokens, token_lengths = [], []
+        text, text_lengths = [], []
+        frequency_terms, frequency_counts = [], []
+        sentence_count = frequency_count = 0
+
+        for filename in sorted(os.listdir(directory)):
+            stat = os.stat(os.path.join(directory, filename))
+            entry = old.files.get(filename) if old else None
+            if (entry and entry["size"] == stat.st_size and
+                    entry["mtime_ns"] == stat.st_mtime_ns):
+
+                # Copy the file's slices across, interning only its words
+                # the new vocabulary doesn't have yet
+                start, end = entry["sentences"]
+                bounds = np.asarray(old.offsets[start:end + 1])
+                old_tokens = np.asarray(old.tokens[bounds[0]:bounds[-1]])
+                first, last = entry["frequencies"]
+                old_terms = np.asarray(old.frequency_terms[first:last])
+                for term in old_terms[remap[old_terms] < 0].tolist():
+                    remap[term] = ids.setdefault(old.vocabulary[term], len(ids))
+                tokens.append(remap[old_tokens])
+                token_lengths.append(np.diff(bounds))
+                text_bounds = np.asarray(old.text_offsets[start:end + 1])
+                text.append(np.asarray(old.text[text_bounds[0]:text_bounds[-1]]))
+                text_lengths.append(np.diff(text_bounds))
+                terms = remap[old_terms]
+                order = np.argsort(terms)
+                terms = terms[order]
+                counts = np.asarray(old.frequency_counts[first:last])[order]
+                sentences = end - start
+            else:
+                source = os.path.join(directory, filename)
+                with open(source, encoding="utf-8", errors="replace") as f:
+                    contents = f.read()
+                distinct = []
+                lengths, encoded_lengths = [], []
+                for sentence in segment(contents):
+                    words = list(tokenizer.words(sentence))
+                    if not words:
+                        continue
+                    encoded_words = np.array(
+                        [ids.setdefault(w, len(ids)) for w in words],
+                        dtype=np.int32
+                    )
+                    tokens.append(encoded_words)
+                    lengths.append(len(encoded_words))
+                    encoded = sentence.encode("utf-8")
+                    text.append(np.frombuffer(encoded, dtype=np.uint8))
+                    encoded_lengths.append(len(encoded))
+                    distinct.append(np.unique(encoded_words))
+                token_lengths.append(np.array(lengths, dtype=np.int64))
+                text_lengths.append(np.array(encoded_lengths, dtype=np.int64))
+                terms, counts = np.unique(
+                    np.concatenate(distinct) if distinct else np.zeros(0, np.int32),
+                    return_counts=True
+                )
+                sentences = len(lengths)
+
+            frequency_terms.append(terms.astype(np.int32))
+            frequency_counts.append(counts.astype(np.int32))
+            files[filename] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sentences": [sentence_count, sentence_count + sentences],
+                "frequencies": [frequency_count, frequency_count + len(terms)]
+            }
+            sentence_count += sentences
+            frequency_count += len(terms)
+
+        # Write the arrays of a new generation, then switch to it by
+        # replacing the manifest, and only then remove older generations
+        generation = old.generation + 1 if old else 0
+        os.makedirs(path, exist_ok=True)
+        arrays = {
+            "tokens": concatenate(tokens, np.int32),
+            "offsets": offsets(token_lengths),
+            "text": concatenate(text, np.uint8),
+            "text_offsets": offsets(text_lengths),
+            "frequency_terms": concatenate(frequency_terms, np.int32),
+            "frequency_counts": concatenate(frequency_counts, np.int32)
+        }
+        names = {f"{name}-{generation}.npy" for name in arrays}
+        for name, array in arrays.items():
+            replace_file(
+                os.path.join(path, f"{name}-{generation}.npy"),
+                lambda f, array=array: np.save(f, array)
+            )
+        replace_file(
+            os.path.join(path, "manifest.json"),
+            lambda f: f.write(json.dumps(
+                {"generation": generation, "vocabulary": list(ids), "files": files}
+            ).encode("utf-8"))
+        )
+        for filename in os.listdir(path):
+            if filename.endswith(".npy") and filename not in names:
+                os.remove(os.path.join(path, filename))
+        return cls(path)
+
+    def idfs(self, filenames, terms):
+        """
+        Return an array of the IDF values of the token ids `terms` (a sorted
+        array) across all sentences of `filenames`.
+        """
+        total = 0
+        frequencies = np.zeros(len(terms), dtype=np.int64)
+        for filename in filenames:
+            start, end = self.files[filename]["sentences"]
+            total += end - start
+            start, end = self.files[filename]["frequencies"]
+            found, positions = lookup(self.frequency_terms[start:end], terms)
+            frequencies[found] += self.frequency_counts[start:end][positions[found]]
+
+        idfs = np.zeros(len(terms))
+        present = frequencies > 0
+        idfs[present] = np.log(total / frequencies[present])
+        return idfs
+
+    def top_sentences(self, query, filenames, n):
+        """
+        Return a list of the `n` top sentences of `filenames` that match
+        `query` (a set of words), ranked according to idf, with ties broken
+        by query term density.
+        """
+        terms = np.array(
+            sorted(self.ids[word] for word in query if word in self.ids),
+            dtype=np.int32
+        )
+        if not len(terms) or not filenames:
+            return []
+        idfs = self.idfs(filenames, terms)
+
+        matched, scores, densities = [], [], []
+        for filename in filenames:
+            start, end = self.files[filename]["sentences"]
+            bounds = np.asarray(self.offsets[start:end + 1])
+            lengths = np.diff(bounds)
+            tokens = np.asarray(self.tokens[bounds[0]:bounds[-1]])
+            owners = np.repeat(np.arange(end - start), lengths)
+
+            # Count each query word at most once per sentence
+            found, positions = lookup(terms, tokens)
+            pairs = np.unique(owners[found] * len(terms) + positions[found])
+            owners, positions = pairs // len(terms), pairs % len(terms)
+            score = np.bincount(owners, weights=idfs[positions], minlength=end - start)
+            count = np.bincount(owners, minlength=end - start)
+
+            hits = count > 0
+            matched.append(np.arange(start, end)[hits])
+            scores.append(score[hits])
+            densities.append(count[hits] / lengths[hits])
+
+        matched = np.concatenate(matched)
+        if not len(matched):
+            return []
+        best = top_indices(np.concatenate(scores), n, np.concatenate(densities))
+        return [self.sentence(i) for i in matched[best]]
+
+
+class BatchScorer():
+    """
+    Scores many queries at once against a `SentenceStore`.
+
+    Files are rows of a sparse TF-IDF matrix and sentences are rows of a
+    sparse word-presence matrix, both over the store's vocabulary. A batch
+    of queries is encoded as a sparse query-word matrix, so ranking files
+    for every query in the batch is a single sparse matrix product, whose
+    scores stay sparse. Sentences are only ever scored within each query's
+    top files.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.filenames = list(store.files)
+        width = len(store.vocabulary)
+
+        # Term counts per sentence; files are sums of their sentences
+        offsets = np.array(store.offsets)
+        counts = sparse.csr_matrix(
+            (np.ones(len(store.tokens)), np.array(store.tokens), offsets),
+            shape=(len(offsets) - 1, width)
+        )
+        counts.sum_duplicates()
+        owners = np.zeros(counts.shape[0], dtype=np.int64)
+        for i, filename in enumerate(self.filenames):
+            start, end = store.files[filename]["sentences"]
+            owners[start:end] = i
+        membership = sparse.csr_matrix(
+            (np.ones(len(owners)), (owners, np.arange(len(owners)))),
+            shape=(len(self.filenames), len(owners))
+        )
+        file_counts = (membership @ counts).tocsr()
+        self.files = (file_counts @ sparse.diags(matrix_idfs(file_counts))).tocsr()
+
+        self.sentences = counts.copy()
+        self.sentences.data[:] = 1
+        self.lengths = np.diff(offsets)
+
+        # Sentences weighted by IDF values across the sentences of their own
+        # file, which are the IDF values to use when a query has one top file
+        file_frequencies = (membership @ self.sentences).tocsr()
+        file_frequencies.sort_indices()
+        rows = np.repeat(owners, np.diff(self.sentences.indptr))
+        keys = rows * width + self.sentences.indices
+        frequency_keys = (
+            np.repeat(np.arange(len(self.filenames)), np.diff(file_frequencies.indptr))
+            * width + file_frequencies.indices
+        )
+        frequencies = file_frequencies.data[np.searchsorted(frequency_keys, keys)]
+        sizes = np.asarray(membership.sum(axis=1)).ravel()[rows]
+        self.weighted = self.sentences.copy()
+        self.weighted.data = np.log(sizes / frequencies)
+
+        # The same sentences by word, each entry keyed by word and then
+        # sentence, so the sentences of one file holding a word are a
+        # range found by binary search
+        columns = self.sentences.tocsc()
+        columns.sort_indices()
+        weights = self.weighted.tocsc()
+        weights.sort_indices()
+        self.sentence_rows = columns.indices
+        self.sentence_weights = weights.data
+        self.sentence_keys = (
+            np.repeat(np.arange(width, dtype=np.int64), np.diff(columns.indptr))
+            * counts.shape[0] + columns.indices
+        )
+
+    def encode(self, queries):
+        """
+        Return a sparse matrix with one row per query (a set of words) and a
+        1 in the column of each of its words that the store knows about.
+        """
+        ids = self.store.ids
+        rows, columns = [], []
+        for i, query in enumerate(queries):
+            for word in query:
+                if word in ids:
+                    rows.append(i)
+                    columns.append(ids[word])
+        return sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, columns)),
+            shape=(len(queries), len(ids))
+        )
+
+    def answer(self, queries, file_matches, sentence_matches):
+        """
+        Given a list of `queries` (sets of words), return a list with one
+        tuple (filenames, sentences) per query, holding its top
+        `file_matches` files and top `sentence_matches` sentences.
+        """
+        encoded = self.encode(queries)
+
+        # Rank files for the whole batch at once, keeping the scores sparse:
+        # only files sharing a word with a query are candidates for it
+        scores = (encoded @ self.files.T).tocsr()
+        scores.sort_indices()
+        top = []
+        for i in range(len(queries)):
+            start, end = scores.indptr[i], scores.indptr[i + 1]
+            best = top_indices(scores.data[start:end], file_matches)
+            top.append(tuple(scores.indices[start:end][best].tolist()))
+
+        # Rank sentences of queries with one top file all together
+        sentences = [[] for _ in queries]
+        single = [i for i, files in enumerate(top) if len(files) == 1]
+        found = self.single_file_sentences(
+            encoded[single], [top[i][0] for i in single], sentence_matches
+        )
+        for i, matches in zip(single, found):
+            sentences[i] = matches
+
+        # Rank sentences once per other distinct set of top files, against
+        # only the sentences of those files
+        groups = collections.defaultdict(list)
+        for i, files in enumerate(top):
+            if len(files) > 1:
+                groups[files].append(i)
+        for files, members in groups.items():
+            rows = np.concatenate([
+                np.arange(*self.store.files[self.filenames[f]]["sentences"])
+                for f in files
+            ])
+            presence = self.sentences[rows]
+            weighted = presence @ sparse.diags(matrix_idfs(presence))
+            subset = encoded[members]
+            scores = (subset @ weighted.T).toarray()
+            matched = (subset @ presence.T).toarray()
+            densities = matched / np.maximum(self.lengths[rows], 1)
+            for i, member in enumerate(members):
+                hits = np.flatnonzero(matched[i])
+                best = hits[top_indices(
+                    scores[i][hits], sentence_matches, densities[i][hits]
+                )]
+                sentences[member] = [self.store.sentence(r) for r in rows[best]]
+
+        return [
+            ([self.filenames[f] for f in files], found)
+            for files, found in zip(top, sentences)
+        ]
+
+
+    def single_file_sentences(self, encoded, files, n):
+        """
+        Given `encoded` queries and the index of one top file for each, in
+        `files`, return a list with the `n` top sentences of its file for
+        each query, ranked by the IDF values of the sentences of that file.
+
+        Only the sentences of each query's file holding one of its words are
+        ever looked at: each (query, word) pair binary searches the range of
+        such sentences in `self.sentence_keys`, and the scores of all pairs
+        are summed per (query, sentence) at once.
+        """
+        size = self.sentences.shape[0]
+        queries = np.repeat(np.arange(len(files)), np.diff(encoded.indptr))
+        words = encoded.indices.astype(np.int64)
+        bounds = np.array(
+            [self.store.files[self.filenames[f]]["sentences"] for f in files],
+            dtype=np.int64
+        ).reshape(-1, 2)[queries]
+        low = np.searchsorted(self.sentence_keys, words * size + bounds[:, 0])
+        high = np.searchsorted(self.sentence_keys, words * size + bounds[:, 1])
+
+        # Expand each range into the positions of its entries
+        lengths = high - low
+        positions = (
+            np.repeat(low - np.cumsum(lengths) + lengths, lengths)
+            + np.arange(lengths.sum())
+        )
+        keys = np.repeat(queries, lengths) * size + self.sentence_rows[positions]
+        keys, inverse = np.unique(keys, return_inverse=True)
+        scores = np.bincount(inverse, weights=self.sentence_weights[positions])
+        counts = np.bincount(inverse)
+        owners, rows = keys // size, keys % size
+        densities = counts / self.lengths[rows]
+
+        # Order each query's sentences best first, like `top_indices`
+        order = np.lexsort((rows, -densities, -scores, owners))
+        owners, rows = owners[order], rows[order]
+        ranks = np.arange(len(owners)) - np.searchsorted(owners, owners)
+        found = [[] for _ in files]
+        for owner, row in zip(owners[ranks < n].tolist(), rows[ranks < n].tolist()):
+            found[owner].append(self.store.sentence(row))
+        return found
+
+
+def lookup(keys, values):
+    """
+    Given a sorted array `keys`, return a tuple (found, positions) of a
+    boolean array marking which `values` are in `keys`, and their positions.
+    """
+    positions = np.searchsorted(keys, values)
+    if not len(keys):
+        return np.zeros(len(values), dtype=bool), positions
+    positions = np.minimum(positions, len(keys) - 1)
+    return np.asarray(keys)[positions] == values, positions
+
+
+def concatenate(arrays, dtype):
+    """
+    Concatenate a list of arrays, which may be empty, into one of `dtype`.
+    """
+    if not arrays:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(arrays).astype(dtype, copy=False)
+
+
+def offsets(lengths):
+    """
+    Return the int64 offsets bounding consecutive runs of the given
+    `lengths`, a list of arrays: 0, then their running total.
+    """
+    return np.concatenate([[0], np.cumsum(concatenate(lengths, np.int64))]).astype(np.int64)
+
+
+def replace_file(path, write):
+    """
+    Atomically replace the file at `path` with what `write` writes to a
+    binary file object, so readers never observe a partial file.
+    """
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        write(f)
+    os.replace(temporary, path)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
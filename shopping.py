@@ -1,43 +1,199 @@
+import argparse
+import concurrent.futures
 import csv
+import itertools
+import json
+import numpy as np
+import os
+import pickle
+import queue
+import socket
+import stat
 import sys
+import threading
+import time
+import tracemalloc
 
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.ensemble import HistGradientBoostingClassifier
+from sklearn.linear_model import LogisticRegression
 from sklearn.model_selection import train_test_split
+from sklearn.naive_bayes import GaussianNB
 from sklearn.neighbors import KNeighborsClassifier
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
 
 TEST_SIZE = 0.4
+CHUNK_SIZE = 65536
+
+# Nearest-neighbor search structures `train_model` can build; all but
+# "rp_forest", which is approximate, are exact
+ALGORITHMS = ["kd_tree", "ball_tree", "brute", "auto", "rp_forest"]
+LEAF_SIZE = 40
+
+# Random projection forest defaults: more trees or larger leaves find the
+# true nearest neighbor more often, at the cost of slower predictions
+FOREST_TREES = 8
+FOREST_LEAF_SIZE = 32
+FOREST_BATCH_SIZE = 256
+
+# Forest sizes compared against exact search by --benchmark
+BENCHMARK_TREES = [1, 4, 8, 16]
+
+# Seed for shuffling records into cross-validation folds
+FOLD_SEED = 0
+
+# Iterations logistic regression may take to converge
+LOGISTIC_MAX_ITER = 1000
+
+# Scoring service micro-batches: most records scored at once, and how long
+# to wait for more records to join a batch after its first arrives
+SERVE_BATCH_SIZE = 1024
+SERVE_MAX_WAIT = 0.002
+
+# Upper bounds, in milliseconds, of the scoring latency histogram's buckets
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000]
+
+# Evidence columns, in order, and the type each is parsed as
+EVIDENCE = [
+    ("Administrative", np.int64),
+    ("Administrative_Duration", np.float64),
+    ("Informational", np.int64),
+    ("Informational_Duration", np.float64),
+    ("ProductRelated", np.int64),
+    ("ProductRelated_Duration", np.float64),
+    ("BounceRates", np.float64),
+    ("ExitRates", np.float64),
+    ("PageValues", np.float64),
+    ("SpecialDay", np.float64),
+    ("Month", "month"),
+    ("OperatingSystems", np.int64),
+    ("Browser", np.int64),
+    ("Region", np.int64),
+    ("TrafficType", np.int64),
+    ("VisitorType", "visitor"),
+    ("Weekend", "boolean")
+]
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'June', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# Evidence and labels cross-validation worker processes fit folds of
+data = None
 
 # ai to predict whether online shopping customers will complete a purchase
 def main():
 
-    # Check command-line arguments
-    if len(sys.argv) != 2:
-        sys.exit("Usage: python shopping.py data")
+    # Score records with a saved model as they arrive
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        serve_main(sys.argv[2:])
+        return
 
-    # Load data from spreadsheet and split into train and test sets
-    evidence, labels = load_data(sys.argv[1])
-    X_train, X_test, y_train, y_test = train_test_split(
-        evidence, labels, test_size=TEST_SIZE
+    # Check command-line arguments
+    parser = argparse.ArgumentParser(usage="python shopping.py data")
+    parser.add_argument("data")
+    parser.add_argument(
+        "--family", choices=list(MODELS), default="knn",
+        help="kind of model to train"
+    )
+    parser.add_argument(
+        "--algorithm", choices=ALGORITHMS, default=ALGORITHMS[0],
+        help="nearest-neighbor search structure"
+    )
+    parser.add_argument(
+        "--n-jobs", type=int, default=-1,
+        help="processes to query neighbors with (-1 for all cores)"
+    )
+    parser.add_argument("--save", metavar="MODEL", help="save the fitted model")
+    parser.add_argument(
+        "--load", metavar="MODEL",
+        help="evaluate a saved model on all of the data instead of training"
+    )
+    parser.add_argument(
+        "--trees", type=int, default=FOREST_TREES,
+        help="trees in the rp_forest index"
+    )
+    parser.add_argument(
+        "--leaf-size", type=int, default=FOREST_LEAF_SIZE,
+        help="minimum points per leaf of the rp_forest index"
     )
+    parser.add_argument(
+        "--benchmark", action="store_true",
+        help="compare rp_forest sizes against exact search on one split"
+    )
+    parser.add_argument(
+        "--benchmark-models", action="store_true",
+        help="compare every model family on one split"
+    )
+    parser.add_argument(
+        "--folds", type=int,
+        help="cross-validate over this many folds instead of one split"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="number of processes to fit cross-validation folds with"
+    )
+    args = parser.parse_args()
 
-    # Train model and make predictions
-    model = train_model(X_train, y_train)
+    # Load data from spreadsheet and split into train and test sets
+    evidence, labels = load_data(args.data)
+    if args.benchmark:
+        benchmark(
+            *train_test_split(evidence, labels, test_size=TEST_SIZE),
+            leaf_size=args.leaf_size
+        )
+        return
+    if args.benchmark_models:
+        benchmark_models(
+            *train_test_split(evidence, labels, test_size=TEST_SIZE),
+            algorithm=args.algorithm, trees=args.trees,
+            leaf_size=args.leaf_size
+        )
+        return
+    if args.folds:
+        cross_validate(
+            evidence, labels, args.folds, workers=args.workers,
+            family=args.family, algorithm=args.algorithm, trees=args.trees,
+            leaf_size=args.leaf_size
+        )
+        return
+    if args.load:
+        model = load_model(args.load)
+        X_test, y_test = evidence, labels
+    else:
+        X_train, X_test, y_train, y_test = train_test_split(
+            evidence, labels, test_size=TEST_SIZE
+        )
+
+        # Train model
+        model = train_model(
+            X_train, y_train, family=args.family, algorithm=args.algorithm,
+            n_jobs=args.n_jobs, trees=args.trees, leaf_size=args.leaf_size
+        )
+        if args.save:
+            save_model(model, args.save)
+
+    # Make predictions
+    start = time.perf_counter()
     predictions = model.predict(X_test)
+    elapsed = time.perf_counter() - start
     sensitivity, specificity = evaluate(y_test, predictions)
 
     # Print results
-    print(f"Correct: {(y_test == predictions).sum()}")
-    print(f"Incorrect: {(y_test != predictions).sum()}")
+    matrix = confusion_matrix(y_test, predictions)
+    print(f"Correct: {matrix.trace()}")
+    print(f"Incorrect: {matrix.sum() - matrix.trace()}")
     print(f"True Positive Rate: {100 * sensitivity:.2f}%")
     print(f"True Negative Rate: {100 * specificity:.2f}%")
+    print(f"Predictions/sec: {len(y_test) / elapsed:.0f}")
 
 
 def load_data(filename):
     """
-    Load shopping data from a CSV file `filename` and convert into a list of
-    evidence lists and a list of labels. Return a tuple (evidence, labels).
+    Load shopping data from a CSV file `filename` and convert into an
+    evidence array and a labels array. Return a tuple (evidence, labels).
 
-    evidence should be a list of lists, where each list contains the
-    following values, in order:
+    evidence is a float64 NumPy array with one row per record, where each
+    row contains the following values, in order:
         - Administrative, an integer
         - Administrative_Duration, a floating point number
         - Informational, an integer
@@ -56,59 +212,414 @@ def load_data(filename):
         - VisitorType, an integer 0 (not returning) or 1 (returning)
         - Weekend, an integer 0 (if false) or 1 (if true)
 
-    labels should be the corresponding list of labels, where each label
-    is 1 if Revenue is true, and 0 otherwise.
+    labels is the corresponding int64 NumPy array of labels, where each
+    label is 1 if Revenue is true, and 0 otherwise.
+
+    The file is parsed in chunks by `iter_data`, and the chunks are
+    concatenated once at the end.
     """
 
-    labels = []
-    
     evidence = []
+    labels = []
 
-    with open(filename, 'r') as f:
-
-        reader = list(csv.DictReader(f))
+    for chunk_evidence, chunk_labels in iter_data(filename):
+        evidence.append(chunk_evidence)
+        labels.append(chunk_labels)
 
+    if not evidence:
+        return (np.zeros((0, len(EVIDENCE))), np.zeros(0, dtype=np.int64))
+    return (np.concatenate(evidence), np.concatenate(labels))
 
-        for row in reader:
-            ms = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'June', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-            for i in range(len(ms)):
-                if row['Month'] == ms[i]:
-                    row['Month'] = i
-                    break
 
-            
-            row['Weekend'] = 1 if row['Weekend'] == 'TRUE' else 0
+def iter_data(filename, chunk_size=CHUNK_SIZE):
+    """
+    Stream shopping data from the CSV file `filename` in chunks of up to
+    `chunk_size` rows, yielding a tuple (evidence, labels) of NumPy arrays
+    for each, encoded as `load_data` describes. Only one chunk is held in
+    memory at a time, so files larger than memory can be processed.
+
+    Columns are found by name in the header, and each chunk is parsed by
+    `np.loadtxt` straight into one float64 array of the numeric columns
+    and one string array of the categorical ones.
+    """
+    with open(filename, 'r', newline='') as f:
+        header = next(csv.reader([f.readline()]))
+        positions = {name: i for i, name in enumerate(header)}
+        numeric = [name for name, kind in EVIDENCE if not isinstance(kind, str)]
+        categorical = [name for name, kind in EVIDENCE if isinstance(kind, str)]
+        if 'Revenue' in positions:
+            categorical.append('Revenue')
+
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            numbers = np.loadtxt(
+                lines, delimiter=',', quotechar='"', dtype=np.float64, ndmin=2,
+                usecols=[positions[name] for name in numeric]
+            )
+            strings = np.loadtxt(
+                lines, delimiter=',', quotechar='"', dtype=str, ndmin=2,
+                usecols=[positions[name] for name in categorical]
+            )
+            columns = {name: numbers[:, i] for i, name in enumerate(numeric)}
+            columns.update(
+                {name: strings[:, i] for i, name in enumerate(categorical)}
+            )
+            yield encode(columns)
+
+
+def encode(columns):
+    """
+    Given a dictionary mapping column names to sequences of values, as
+    strings or numbers, return a tuple (evidence, labels) of NumPy arrays:
+    `evidence` is a float64 array with one row per record and one column
+    per entry of EVIDENCE, and `labels` an int64 array, which is empty if
+    there is no Revenue column.
+    """
+    n = len(next(iter(columns.values())))
+    evidence = np.empty((n, len(EVIDENCE)), dtype=np.float64)
+
+    for i, (name, kind) in enumerate(EVIDENCE):
+        if kind == "month":
+            evidence[:, i] = encode_categories(np.asarray(columns[name], dtype=str), MONTHS)
+        elif kind == "visitor":
+            evidence[:, i] = np.asarray(columns[name], dtype=str) == 'Returning_Visitor'
+        elif kind == "boolean":
+            evidence[:, i] = np.asarray(columns[name], dtype=str) == 'TRUE'
+        else:
+            evidence[:, i] = np.asarray(columns[name], dtype=np.float64)
 
-            row['VisitorType'] = 1 if row['VisitorType'] == 'Returning_Visitor' else 0
+    if 'Revenue' in columns:
+        labels = (np.asarray(columns['Revenue'], dtype=str) == 'TRUE').astype(np.int64)
+    else:
+        labels = np.zeros(0, dtype=np.int64)
+    return (evidence, labels)
 
-          
-            for floats in ['Administrative_Duration', 'Informational_Duration', 'ProductRelated_Duration', 'BounceRates', 'ExitRates', 'PageValues', 'SpecialDay']:
-                row[floats] = float(row[floats])
-            
-            for ints in ['Administrative', 'Informational', 'ProductRelated', 'OperatingSystems', 'Browser', 'Region', 'TrafficType']:
-                row[ints] = int(row[ints])
 
-            # append the values of the list from csv file to evidence 
-            evidence.append(list(row.values())[:-1])
-            # append all labels to label array
-            labels.append(0 if row['Revenue'] != 'TRUE' else 1)
-    
-    return (evidence, labels)
+def encode_categories(values, categories):
+    """
+    Return an array of the index in the list `categories` of each string in
+    the array `values`, looking up each distinct value only once.
+    """
+    distinct, inverse = np.unique(values, return_inverse=True)
+    index = {category: i for i, category in enumerate(categories)}
+    codes = np.empty(len(distinct), dtype=np.int64)
+    for i, value in enumerate(distinct.tolist()):
+        if value not in index:
+            raise ValueError(f"Unknown category {value!r}")
+        codes[i] = index[value]
+    return codes[inverse]
 
 
 
-def train_model(evidence, labels):
+def train_model(evidence, labels, family="knn", **options):
     """
     Given a list of evidence lists and a list of labels, return a
     fitted k-nearest neighbor model (k=1) trained on the data.
+
+    `family` picks another kind of model from MODELS instead: "logistic"
+    regression, histogram gradient "boosting" or Gaussian naive "bayes",
+    which all predict in time independent of the size of the training
+    set. Keyword `options` configure the nearest neighbor search (see
+    `nearest_neighbor`) and are ignored by the other families.
+
+    Features are standardized before fitting, so no feature dominates
+    distances or gradients by its scale alone.
     """
-    
-    model = KNeighborsClassifier(n_neighbors = 1)
+    if family not in MODELS:
+        raise ValueError(f"Unknown model family {family}")
+    model = make_pipeline(StandardScaler(), MODELS[family](**options))
     model.fit(evidence, labels)
 
     return model
 
 
+def nearest_neighbor(algorithm=ALGORITHMS[0], n_jobs=None,
+                     trees=FOREST_TREES, leaf_size=FOREST_LEAF_SIZE):
+    """
+    Return an unfitted 1-nearest-neighbor classifier. `algorithm` picks
+    the search structure (see ALGORITHMS), built once at fit time, and
+    `n_jobs` the number of processes predictions query it with. The
+    approximate "rp_forest" index instead uses `trees` and `leaf_size`.
+    """
+    if algorithm == "rp_forest":
+        return RandomProjectionForest(trees=trees, leaf_size=leaf_size)
+    return KNeighborsClassifier(
+        n_neighbors=1, algorithm=algorithm, leaf_size=LEAF_SIZE, n_jobs=n_jobs
+    )
+
+
+# Maps names of model families to functions returning unfitted classifiers
+MODELS = {
+    "knn": nearest_neighbor,
+    "logistic": lambda **options: LogisticRegression(max_iter=LOGISTIC_MAX_ITER),
+    "boosting": lambda **options: HistGradientBoostingClassifier(),
+    "bayes": lambda **options: GaussianNB()
+}
+
+
+def save_model(model, filename):
+    """
+    Save a fitted model, including its search index, to `filename`.
+    """
+    with open(filename, 'wb') as f:
+        pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_model(filename):
+    """
+    Load a fitted model saved with `save_model` from `filename`.
+    """
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def serve_main(argv):
+    """
+    Score shopping sessions with a saved model as they arrive, as in
+    `python shopping.py serve model.pkl`, until input ends or the service
+    is interrupted, then print a histogram of scoring latencies.
+
+    Each session is a line of JSON, an object with the CSV's evidence
+    columns (and optionally an "id" to echo back), read from standard
+    input or from clients of a Unix socket. Each is answered with a line
+    of JSON holding its "prediction", or an "error" if it can't be read.
+    """
+    parser = argparse.ArgumentParser(prog="python shopping.py serve")
+    parser.add_argument("model")
+    parser.add_argument(
+        "--socket", metavar="PATH",
+        help="serve clients of a Unix socket at PATH instead of standard input"
+    )
+    parser.add_argument("--batch-size", type=int, default=SERVE_BATCH_SIZE)
+    parser.add_argument(
+        "--max-wait", type=float, default=1000 * SERVE_MAX_WAIT,
+        help="milliseconds to wait for a batch to fill after its first record"
+    )
+    args = parser.parse_args(argv)
+
+    model = load_model(args.model)
+    requests = queue.Queue()
+    if args.socket:
+        listen(args.socket, requests)
+    else:
+        threading.Thread(
+            target=read_requests, args=(sys.stdin.buffer, None, requests),
+            daemon=True
+        ).start()
+
+    latencies = []
+    batches = 0
+    started = finished = None
+    try:
+        for batch in micro_batches(requests, args.batch_size, args.max_wait / 1000):
+            batches += 1
+            started = started or batch[0][0]
+            running = respond(model, batch, latencies)
+            finished = time.perf_counter()
+            if not running:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+        if latencies:
+            print_latencies(latencies, batches, finished - started)
+
+
+def listen(path, requests):
+    """
+    Accept clients on a Unix socket at `path` in a background thread,
+    queueing each line a client sends in `requests` to be answered on
+    its connection.
+    """
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+
+    def accept():
+        while True:
+            connection, _ = server.accept()
+            threading.Thread(
+                target=read_requests,
+                args=(connection.makefile('rb'), connection.makefile('wb'), requests),
+                daemon=True
+            ).start()
+            connection.close()
+
+    threading.Thread(target=accept, daemon=True).start()
+
+
+def read_requests(lines, stream, requests):
+    """
+    Queue each line of `lines` in `requests` as a tuple (time received,
+    line, stream to answer on), where `stream` None means standard
+    output, followed by one with line None once `lines` ends.
+    """
+    for line in lines:
+        if line.strip():
+            requests.put((time.perf_counter(), line, stream))
+    lines.close()
+    requests.put((time.perf_counter(), None, stream))
+
+
+def micro_batches(requests, batch_size, max_wait):
+    """
+    Yield lists of up to `batch_size` requests from the queue `requests`,
+    waiting up to `max_wait` seconds after the first of each to fill it.
+    """
+    while True:
+        batch = [requests.get()]
+        deadline = time.perf_counter() + max_wait
+        while len(batch) < batch_size:
+            try:
+                batch.append(requests.get(timeout=max(deadline - time.perf_counter(), 0)))
+            except queue.Empty:
+                break
+        yield batch
+
+
+def respond(model, batch, latencies):
+    """
+    Score the requests in `batch` with `model` together, write each
+    answer to the stream it came from, and add each request's time from
+    arrival to answer to the list `latencies`. Return False once standard
+    input has ended, so the service should stop, and True otherwise.
+    """
+    answers = score_records([line for _, line, _ in batch if line is not None], model)
+    output = {}
+    for _, line, stream in batch:
+        if line is not None:
+            output.setdefault(stream, []).append(json.dumps(next(answers)).encode() + b"\n")
+
+    running = True
+    for stream, lines in output.items():
+        stream = stream or sys.stdout.buffer
+        try:
+            stream.write(b"".join(lines))
+            stream.flush()
+        except OSError:
+            pass
+    now = time.perf_counter()
+    latencies.extend(now - received for received, line, _ in batch if line is not None)
+
+    for _, line, stream in batch:
+        if line is None:
+            if stream is None:
+                running = False
+            else:
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+    return running
+
+
+def score_records(lines, model):
+    """
+    Return an iterator over answers to each JSON session record in
+    `lines`, predicting them all with `model` in one batch, encoded as
+    `load_data` encodes them. Records that can't be read or encoded are
+    answered with an "error" instead.
+    """
+    answers = [None] * len(lines)
+    records = {}
+    for i, line in enumerate(lines):
+        try:
+            records[i] = json.loads(line)
+        except ValueError as e:
+            answers[i] = error(e)
+
+    # Only if the whole batch can't be encoded, encode records one at a
+    # time, answering those at fault and stacking the rest
+    try:
+        evidence = encode_records(records.values())
+    except (ValueError, KeyError, TypeError):
+        rows = []
+        for i, record in list(records.items()):
+            try:
+                rows.append(encode_records([record]))
+            except (ValueError, KeyError, TypeError) as e:
+                answers[i] = error(e, record)
+                del records[i]
+        evidence = np.vstack(rows) if rows else encode_records([])
+
+    if records:
+        predictions = model.predict(evidence).tolist()
+        for (i, record), prediction in zip(records.items(), predictions):
+            answers[i] = {"prediction": prediction}
+            if "id" in record:
+                answers[i] = {"id": record["id"], **answers[i]}
+    return iter(answers)
+
+
+def encode_records(records):
+    """
+    Return the evidence array `encode` makes of JSON session `records`,
+    dictionaries mapping the CSV's column names to values.
+    """
+    records = list(records)
+    if not records:
+        return np.zeros((0, len(EVIDENCE)))
+    return encode({
+        name: [record_value(record[name]) for record in records]
+        for name, _ in EVIDENCE
+    })[0]
+
+
+def error(e, record=None):
+    """
+    Return the answer to a `record` that failed with exception `e`,
+    echoing its "id" if it has one.
+    """
+    answer = {"error": f"{type(e).__name__}: {e}"}
+    if isinstance(record, dict) and "id" in record:
+        answer = {"id": record["id"], **answer}
+    return answer
+
+
+def record_value(value):
+    """
+    Return a JSON record's `value` as `encode` expects it: booleans as the
+    CSV's "TRUE" or "FALSE", and strings and numbers unchanged. Raise
+    TypeError for anything else, such as lists and objects.
+    """
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if not isinstance(value, (str, int, float)):
+        raise TypeError(f"Expected a string or number, not {type(value).__name__}")
+    return value
+
+
+def print_latencies(latencies, batches, elapsed):
+    """
+    Print to standard error a histogram of the scoring `latencies`, in
+    seconds, across `batches` batches answered in `elapsed` seconds, with
+    their percentiles and throughput.
+    """
+    milliseconds = 1000 * np.asarray(latencies)
+    counts = np.bincount(
+        np.searchsorted(LATENCY_BUCKETS, milliseconds),
+        minlength=len(LATENCY_BUCKETS) + 1
+    )
+    print(
+        f"{len(latencies)} records in {batches} batches: "
+        f"{len(latencies) / elapsed:.0f} records/sec, "
+        f"p50 {np.percentile(milliseconds, 50):.2f} ms, "
+        f"p99 {np.percentile(milliseconds, 99):.2f} ms, "
+        f"max {milliseconds.max():.2f} ms",
+        file=sys.stderr
+    )
+    labels = [f"<= {bound:g} ms" for bound in LATENCY_BUCKETS] + [f"> {LATENCY_BUCKETS[-1]:g} ms"]
+    for label, count in zip(labels, counts):
+        bar = "#" * int(np.ceil(50 * count / counts.max()))
+        print(f"{label:>12}{count:>10}  {bar}", file=sys.stderr)
+
+
 def evaluate(labels, predictions):
     """
     Given a list of actual labels and a list of predicted labels,
@@ -124,25 +635,364 @@ def evaluate(labels, predictions):
     representing the "true negative rate": the proportion of
     actual negative labels that were accurately identified.
     """
-    
-    negatives = {'labels': 0, 'predictions': 0}
-    positives = {'labels': 0, 'predictions': 0}
+    matrix = confusion_matrix(labels, predictions)
+    with np.errstate(invalid='ignore'):
+        sensitivity = matrix[1, 1] / matrix[1].sum()
+        specificity = matrix[0, 0] / matrix[0].sum()
 
-    for i in range(len(labels)):
-        if labels[i] != 1:
-            negatives['labels'] = negatives['labels'] + 1
-            negatives['predictions'] = negatives['predictions'] + 1 - predictions[i]
-        else:
-            positives['labels'] = positives['labels'] + 1
-            positives['predictions'] = positives['predictions'] + predictions[i]
+    return (float(sensitivity), float(specificity))
+
+
+def confusion_matrix(labels, predictions):
+    """
+    Return the 2x2 confusion matrix of 0/1 `labels` and `predictions`, as
+    an array whose rows are actual and columns predicted labels.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    predictions = np.asarray(predictions, dtype=np.int64)
+    return np.bincount(2 * labels + predictions, minlength=4).reshape(2, 2)
 
-    sensitivity = positives['predictions'] / positives['labels']
-    specificity = negatives['predictions'] / negatives['labels']
 
-    return (sensitivity, specificity)
+def roc_curve(labels, scores):
+    """
+    Return a tuple (false positive rates, true positive rates, thresholds)
+    of arrays tracing the ROC curve of 0/1 `labels` ranked by `scores`,
+    with one point per distinct score, predicting positive at or above it,
+    after a first point (0, 0).
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    scores = np.asarray(scores, dtype=np.float64)
+    order = np.argsort(-scores, kind='stable')
+    scores = scores[order]
+    true_positives = np.cumsum(labels[order])
+    false_positives = np.arange(1, len(labels) + 1) - true_positives
+
+    # Only the last of a run of equal scores is a point on the curve
+    last = np.flatnonzero(np.r_[scores[1:] != scores[:-1], True])
+    with np.errstate(invalid='ignore'):
+        tpr = np.r_[0, true_positives[last]] / true_positives[-1]
+        fpr = np.r_[0, false_positives[last]] / false_positives[-1]
+    return (fpr, tpr, np.r_[np.inf, scores[last]])
+
+
+def roc_auc(labels, scores):
+    """
+    Return the area under the ROC curve of 0/1 `labels` ranked by `scores`.
+    """
+    fpr, tpr, _ = roc_curve(labels, scores)
+    return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+
+def score(model, evidence):
+    """
+    Return `model`'s score for each row of `evidence` being positive: its
+    probability if it estimates one, and otherwise its 0/1 prediction.
+    """
+    if hasattr(model, "predict_proba"):
+        return model.predict_proba(evidence)[:, 1]
+    return model.predict(evidence)
+
+
+def cross_validate(evidence, labels, folds, workers=None, **options):
+    """
+    Estimate how well `train_model`, given keyword `options`, generalizes
+    by k-fold cross-validation: split the data into `folds` stratified
+    folds, fit a model on all but each in turn across a pool of `workers`
+    processes, and print each fold's timings and metrics and their mean.
+
+    The data is sent to each worker once, when it starts, and each fold's
+    model queries neighbors in a single process, as the pool already
+    keeps every core busy.
+    """
+    assignments = assign_folds(labels, folds)
+    workers = min(workers or os.cpu_count(), folds)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=set_data,
+        initargs=((evidence, labels),)
+    ) as executor:
+        results = executor.map(
+            fit_fold, [assignments == fold for fold in range(folds)],
+            itertools.repeat(options)
+        )
+
+        print(f"{'fold':<6}{'train':>8}{'test':>8}{'fit s':>8}{'pred s':>8}{'TPR':>8}{'TNR':>8}{'AUC':>8}")
+        rows = []
+        for fold, result in enumerate(results):
+            rows.append(result)
+            print(
+                f"{fold:<6}{result['train']:>8}{result['test']:>8}"
+                f"{result['fit']:>8.2f}{result['predict']:>8.2f}"
+                f"{100 * result['sensitivity']:>7.2f}%"
+                f"{100 * result['specificity']:>7.2f}%{result['auc']:>8.3f}"
+            )
+
+    means = {key: np.mean([row[key] for row in rows]) for key in rows[0]}
+    print(
+        f"{'mean':<6}{means['train']:>8.0f}{means['test']:>8.0f}"
+        f"{means['fit']:>8.2f}{means['predict']:>8.2f}"
+        f"{100 * means['sensitivity']:>7.2f}%"
+        f"{100 * means['specificity']:>7.2f}%{means['auc']:>8.3f}"
+    )
+    return rows
+
+
+def assign_folds(labels, folds, seed=FOLD_SEED):
+    """
+    Return an array assigning each record one of `folds` folds at random,
+    such that each fold holds nearly the same share of each label.
+    """
+    labels = np.asarray(labels)
+    order = np.random.default_rng(seed).permutation(len(labels))
+    order = order[np.argsort(labels[order], kind='stable')]
+    assignments = np.empty(len(labels), dtype=np.int64)
+    assignments[order] = np.arange(len(labels)) % folds
+    return assignments
+
+
+def set_data(shared):
+    """
+    Use the evidence and labels `shared` in this worker process.
+    """
+    global data
+    data = shared
+
+
+def fit_fold(test, options):
+    """
+    Fit a model with `train_model` keyword `options` on the records not
+    selected by the boolean mask `test`, and evaluate it on those that
+    are. Return a dictionary of the fold's sizes, timings and metrics.
+    """
+    evidence, labels = data
+    start = time.perf_counter()
+    model = train_model(evidence[~test], labels[~test], n_jobs=1, **options)
+    fitted = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predictions = model.predict(evidence[test])
+    predicted = time.perf_counter() - start
+    sensitivity, specificity = evaluate(labels[test], predictions)
+
+    return {
+        "train": int((~test).sum()),
+        "test": int(test.sum()),
+        "fit": fitted,
+        "predict": predicted,
+        "sensitivity": sensitivity,
+        "specificity": specificity,
+        "auc": roc_auc(labels[test], score(model, evidence[test]))
+    }
+
+
+def benchmark(X_train, X_test, y_train, y_test, leaf_size=FOREST_LEAF_SIZE):
+    """
+    Fit exact 1-NN and random projection forests of each size in
+    BENCHMARK_TREES on the same split, and print for each its fit time,
+    predictions per second, recall (the fraction of test points whose
+    exact nearest neighbor is found) and sensitivity and specificity.
+    """
+    start = time.perf_counter()
+    exact = train_model(X_train, y_train, n_jobs=-1)
+    exact_fitted = time.perf_counter() - start
+    scaled = exact[0].transform(X_test)
+
+    print(f"{'model':<16}{'fit s':>8}{'pred/s':>10}{'recall':>8}{'TPR':>8}{'TNR':>8}")
+    for trees in [None] + BENCHMARK_TREES:
+        if trees is None:
+            name, model, fitted = "exact", exact, exact_fitted
+        else:
+            name = f"rp_forest x{trees}"
+            start = time.perf_counter()
+            model = train_model(
+                X_train, y_train, algorithm="rp_forest", trees=trees,
+                leaf_size=leaf_size
+            )
+            fitted = time.perf_counter() - start
+
+        start = time.perf_counter()
+        found, indices = model[-1].kneighbors(scaled, n_neighbors=1)
+        elapsed = time.perf_counter() - start
+        if trees is None:
+            distances = found
+        recall = np.mean(found <= distances * (1 + 1e-9))
+        predictions = y_train[indices[:, 0]]
+        sensitivity, specificity = evaluate(y_test, predictions)
+        print(
+            f"{name:<16}{fitted:>8.2f}{len(y_test) / elapsed:>10.0f}"
+            f"{100 * recall:>7.1f}%{100 * sensitivity:>7.2f}%"
+            f"{100 * specificity:>7.2f}%"
+        )
+
+
+def benchmark_models(X_train, X_test, y_train, y_test, **options):
+    """
+    Fit a model of each family in MODELS, with nearest neighbor `options`,
+    on the same split, and print for each its fit time, predictions per
+    second, peak memory allocated while fitting and while predicting, size
+    once saved, and sensitivity, specificity and ROC AUC.
+
+    Peak memory is measured with `tracemalloc`, which sees Python and
+    NumPy allocations but not those native code makes directly, in a
+    second, traced fit and predict, so tracing doesn't skew the timings.
+    """
+    print(
+        f"{'family':<10}{'fit s':>8}{'pred/s':>10}{'fit MB':>8}"
+        f"{'pred MB':>8}{'size KB':>10}{'TPR':>8}{'TNR':>8}{'AUC':>8}"
+    )
+    for family in MODELS:
+        start = time.perf_counter()
+        model = train_model(X_train, y_train, family=family, **options)
+        fitted = time.perf_counter() - start
+
+        start = time.perf_counter()
+        predictions = model.predict(X_test)
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        traced = train_model(X_train, y_train, family=family, **options)
+        fit_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        traced.predict(X_test)
+        predict_peak = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+        del traced
+
+        size = len(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL))
+        sensitivity, specificity = evaluate(y_test, predictions)
+        auc = roc_auc(y_test, score(model, X_test))
+        print(
+            f"{family:<10}{fitted:>8.2f}{len(y_test) / elapsed:>10.0f}"
+            f"{fit_peak / 2 ** 20:>8.1f}{predict_peak / 2 ** 20:>8.1f}"
+            f"{size / 1024:>10.0f}{100 * sensitivity:>7.2f}%"
+            f"{100 * specificity:>7.2f}%{auc:>8.3f}"
+        )
+
+
+class RandomProjectionForest(BaseEstimator, ClassifierMixin):
+    """
+    Approximate 1-nearest-neighbor classifier over a forest of random
+    projection trees.
+
+    Each tree splits the training points at the median of their
+    projection onto a random direction, recursively, until leaves hold
+    between `leaf_size` and twice `leaf_size` points. A query descends
+    every tree to one leaf and is labeled by the closest point among the
+    leaves it reaches. More `trees` or a larger `leaf_size` make finding
+    the true nearest neighbor more likely, at the cost of comparing
+    against more candidates.
+    """
 
-    
-    
+    def __init__(self, trees=FOREST_TREES, leaf_size=FOREST_LEAF_SIZE,
+                 batch_size=FOREST_BATCH_SIZE, random_state=None):
+        self.trees = trees
+        self.leaf_size = leaf_size
+        self.batch_size = batch_size
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        """
+        Build the forest over training points `X` with labels `y`.
+        """
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        self.classes_, self.labels_ = np.unique(y, return_inverse=True)
+        self.points_ = X
+        rng = np.random.default_rng(self.random_state)
+
+        n = len(X)
+        self.depth_ = int(np.log2(n / self.leaf_size)) if n >= 2 * self.leaf_size else 0
+        self.directions_ = []
+        self.thresholds_ = []
+        self.leaves_ = []
+        for _ in range(self.trees):
+            directions, thresholds, leaves = self._build_tree(X, rng)
+            self.directions_.append(directions)
+            self.thresholds_.append(thresholds)
+            self.leaves_.append(leaves)
+        return self
+
+    def _build_tree(self, X, rng):
+        """
+        Build one tree, level by level. Return its node directions and
+        thresholds in heap order, and a (leaves, points per leaf) array
+        of training point indices, short leaves padded with repeats.
+        """
+        n, features = X.shape
+        nodes = 2 ** self.depth_ - 1
+        directions = rng.standard_normal((nodes, features))
+        thresholds = np.empty(nodes)
+        order = np.arange(n)
+
+        # Nodes at each level split the points, kept grouped by node in
+        # `order`, into contiguous segments of near-equal size
+        for level in range(self.depth_):
+            width = 2 ** level
+            bounds = np.arange(width + 1) * n // width
+            segment = np.repeat(np.arange(width), np.diff(bounds))
+            node = width - 1 + segment
+            projections = np.einsum('ij,ij->i', X[order], directions[node])
+            sort = np.lexsort((projections, segment))
+            order = order[sort]
+            projections = projections[sort]
+
+            middle = (2 * np.arange(width) + 1) * n // (2 * width)
+            thresholds[width - 1:2 * width - 1] = (
+                projections[middle - 1] + projections[middle]
+            ) / 2
+
+        width = 2 ** self.depth_
+        bounds = np.arange(width + 1) * n // width
+        sizes = np.diff(bounds)
+        offsets = np.minimum(np.arange(sizes.max()), sizes[:, None] - 1)
+        return directions, thresholds, order[bounds[:-1, None] + offsets]
+
+    def kneighbors(self, X, n_neighbors=1):
+        """
+        Return a tuple (distances, indices) of arrays with one column,
+        giving for each row of `X` the closest training point found and
+        its Euclidean distance. Only `n_neighbors=1` is supported.
+        """
+        if n_neighbors != 1:
+            raise ValueError("RandomProjectionForest only finds 1 neighbor")
+        X = np.asarray(X, dtype=np.float64)
+        distances = np.empty((len(X), 1))
+        indices = np.empty((len(X), 1), dtype=np.int64)
+
+        for start in range(0, len(X), self.batch_size):
+            queries = X[start:start + self.batch_size]
+            candidates = np.concatenate([
+                leaves[self._descend(queries, directions, thresholds)]
+                for directions, thresholds, leaves in zip(
+                    self.directions_, self.thresholds_, self.leaves_
+                )
+            ], axis=1)
+            differences = self.points_[candidates] - queries[:, None, :]
+            squared = np.einsum('ijk,ijk->ij', differences, differences)
+            closest = squared.argmin(axis=1)
+            rows = np.arange(len(queries))
+            distances[start:start + len(queries), 0] = np.sqrt(squared[rows, closest])
+            indices[start:start + len(queries), 0] = candidates[rows, closest]
+
+        return (distances, indices)
+
+    def _descend(self, X, directions, thresholds):
+        """
+        Return the index of the leaf each row of `X` falls in, in the
+        tree with the given node `directions` and `thresholds`.
+        """
+        node = np.zeros(len(X), dtype=np.int64)
+        for _ in range(self.depth_):
+            projections = np.einsum('ij,ij->i', X, directions[node])
+            node = 2 * node + 1 + (projections > thresholds[node])
+        return node - (2 ** self.depth_ - 1)
+
+    def predict(self, X):
+        """
+        Return the label of the closest training point found for each
+        row of `X`.
+        """
+        _, indices = self.kneighbors(X)
+        return self.classes_[self.labels_[indices[:, 0]]]
 
 
 if __name__ == "__main__":
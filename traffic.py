@@ -1,8 +1,12 @@
+import argparse
+import concurrent.futures
 import cv2
+import hashlib
 import numpy as np
 import os
 import sys
 import tensorflow as tf
+import time
 
 from sklearn.model_selection import train_test_split
 
@@ -11,40 +15,216 @@ IMG_WIDTH = 30
 IMG_HEIGHT = 30
 NUM_CATEGORIES = 43
 TEST_SIZE = 0.4
+BATCH_SIZE = 32
+SHUFFLE_BUFFER = 2048
+QUANTIZATION_SAMPLES = 200
+
+# Ranges of random augmentations: rotation in radians, scale as a
+# fraction, shift in pixels, brightness in pixel values, contrast as a
+# fraction, and the probability of blurring an image
+AUGMENT_ROTATION = 0.2
+AUGMENT_SCALE = 0.1
+AUGMENT_SHIFT = 2.0
+AUGMENT_BRIGHTNESS = 32.0
+AUGMENT_CONTRAST = 0.3
+AUGMENT_BLUR = 0.25
+
+# First and last training batches to trace when profiling
+PROFILE_BATCHES = (10, 20)
 
 
 def main():
 
-    # Check command-line arguments
-    if len(sys.argv) not in [2, 3]:
-        sys.exit("Usage: python traffic.py data_directory [model.h5]")
+    # Classify images with a saved model instead of training one
+    if len(sys.argv) > 1 and sys.argv[1] == "predict":
+        predict_main(sys.argv[2:])
+        return
 
-    # Get image arrays and labels for all image files
-    images, labels = load_data(sys.argv[1])
+    # Compare the sizes of the model architectures
+    if sys.argv[1:] == ["report"]:
+        report_main()
+        return
 
-    # Split data into training and testing sets
-    labels = tf.keras.utils.to_categorical(labels)
-    x_train, x_test, y_train, y_test = train_test_split(
-        np.array(images), np.array(labels), test_size=TEST_SIZE
+    # Check command-line arguments
+    parser = argparse.ArgumentParser(
+        usage="python traffic.py data_directory [model.h5]"
+    )
+    parser.add_argument("data_directory")
+    parser.add_argument("model", nargs="?")
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="decode images in a tf.data pipeline while training runs, "
+             "instead of loading them all first"
+    )
+    parser.add_argument(
+        "--cache",
+        help="directory of preprocessed image caches; images are decoded "
+             "into it on first use and memory-mapped from it afterwards"
+    )
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="number of threads to decode images with"
+    )
+    parser.add_argument(
+        "--architecture", choices=list(ARCHITECTURES), default="baseline",
+        help="model architecture; see python traffic.py report"
+    )
+    parser.add_argument(
+        "--intra-op-threads", type=int, default=0,
+        help="threads used within each TensorFlow op (0 lets TF choose)"
+    )
+    parser.add_argument(
+        "--inter-op-threads", type=int, default=0,
+        help="threads used to run independent ops (0 lets TF choose)"
+    )
+    parser.add_argument(
+        "--mixed-precision", action="store_true",
+        help="compute in bfloat16 while keeping float32 weights"
+    )
+    parser.add_argument(
+        "--xla", action="store_true",
+        help="compile training and evaluation steps with XLA"
     )
+    parser.add_argument(
+        "--profile", metavar="LOG_DIRECTORY",
+        help="write a TensorFlow profiler trace of a few training batches"
+    )
+    parser.add_argument(
+        "--augment", action="store_true",
+        help="randomly augment training batches (needs --stream or --cache)"
+    )
+    parser.add_argument(
+        "--benchmark-augmentation", action="store_true",
+        help="report augmentation throughput on the training set and exit"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="seed for the train/test split, shuffling, weight initialization "
+             "and augmentations"
+    )
+    args = parser.parse_args()
+    augmenting = args.augment or args.benchmark_augmentation
+    if augmenting and not (args.stream or args.cache):
+        parser.error("augmentation needs --stream or --cache")
+
+    # Configure the runtime before any op executes
+    tf.keras.utils.set_random_seed(args.seed)
+    tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
+    if args.mixed_precision:
+        tf.keras.mixed_precision.set_global_policy("mixed_bfloat16")
+
+    if args.cache:
+
+        # Split indices into the memory-mapped cache, not the images
+        images, labels = load_cache(
+            args.data_directory, args.cache, workers=args.workers
+        )
+        train_indices, test_indices = train_test_split(
+            np.flatnonzero(labels >= 0), test_size=TEST_SIZE,
+            random_state=args.seed
+        )
+        train = index_dataset(
+            images, labels, train_indices, args.batch_size, shuffle=True,
+            seed=args.seed
+        )
+        train_size = len(train_indices)
+        test = index_dataset(images, labels, test_indices, args.batch_size)
+    elif args.stream:
+
+        # Split file paths, and decode images as batches are needed
+        paths, labels = list_images(args.data_directory)
+        paths_train, paths_test, y_train, y_test = train_test_split(
+            paths, labels, test_size=TEST_SIZE, random_state=args.seed
+        )
+        train = make_dataset(
+            paths_train, y_train, args.batch_size, shuffle=True, seed=args.seed
+        )
+        train_size = len(paths_train)
+        test = make_dataset(paths_test, y_test, args.batch_size)
+    else:
+
+        # Get image arrays and labels for all image files
+        images, labels = load_data(args.data_directory, workers=args.workers)
+
+        # Split data into training and testing sets
+        labels = tf.keras.utils.to_categorical(labels, NUM_CATEGORIES)
+        x_train, x_test, y_train, y_test = train_test_split(
+            images, labels, test_size=TEST_SIZE, random_state=args.seed
+        )
+        train = (x_train, y_train)
+        train_size = len(x_train)
+        test = (x_test, y_test)
+
+    # Augment training batches between the loader and the model
+    if args.benchmark_augmentation:
+        augmented, plain, pipelined = augmentation_throughput(train, args.seed)
+        print(f"Augmented {augmented:.0f} images/sec in memory.")
+        print(
+            f"Input pipeline: {plain:.0f} images/sec without augmentation, "
+            f"{pipelined:.0f} images/sec with it."
+        )
+        return
+    if args.augment:
+        train = augment_dataset(train, args.seed)
 
     # Get a compiled neural network
-    model = get_model()
+    model = get_model(args.architecture, jit_compile=args.xla)
 
-    # Fit model on training data
-    model.fit(x_train, y_train, epochs=EPOCHS)
+    # Time every epoch, and trace a few batches if asked to
+    callbacks = [EpochTimer(train_size)]
+    if args.profile:
+        callbacks.append(ProfileBatches(args.profile, *PROFILE_BATCHES))
 
-    # Evaluate neural network performance
-    model.evaluate(x_test,  y_test, verbose=2)
+    # Fit model on training data, then evaluate neural network performance
+    if isinstance(train, tf.data.Dataset):
+        model.fit(train, epochs=EPOCHS, callbacks=callbacks)
+        model.evaluate(test, verbose=2)
+    else:
+        model.fit(
+            *train, epochs=EPOCHS, batch_size=args.batch_size,
+            callbacks=callbacks
+        )
+        model.evaluate(*test, verbose=2)
 
     # Save model to file
-    if len(sys.argv) == 3:
-        filename = sys.argv[2]
+    if args.model:
+        filename = args.model
         model.save(filename)
         print(f"Model saved to {filename}.")
 
 
-def load_data(data_dir):
+def list_images(data_dir):
+    """
+    Return tuple `(paths, labels)` of the path of every image file in the
+    category directories of `data_dir`, and the integer label of each.
+    """
+    paths = list()
+    labels = list()
+
+    for f in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, f)
+        if os.path.isdir(path):
+            for file in sorted(os.listdir(path)):
+                paths.append(os.path.join(path, file))
+                labels.append(int(f))
+
+    return paths, labels
+
+
+def read_image(path):
+    """
+    Read the image file at `path` and resize it to IMG_WIDTH x IMG_HEIGHT.
+    Return it as a uint8 numpy ndarray of shape (IMG_HEIGHT, IMG_WIDTH, 3).
+    """
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Could not read image {path}")
+    return cv2.resize(image, (IMG_WIDTH, IMG_HEIGHT), interpolation=cv2.INTER_AREA)
+
+
+def load_data(data_dir, workers=None):
     """
     Load image data from directory `data_dir`.
     Assume `data_dir` has one directory named after each category, numbered
@@ -55,38 +235,311 @@ def load_data(data_dir):
     numpy ndarray with dimensions IMG_WIDTH x IMG_HEIGHT x 3. `labels` should
     be a list of integer labels, representing the categories for each of the
     corresponding `images`.
+
+    Images are decoded and resized by a pool of `workers` threads straight
+    into one preallocated uint8 array, which is returned as `images`, so
+    they are only ever held in memory once.
     """
-    labels = list()
-    images = list()
-    
+    paths, labels = list_images(data_dir)
+    images = np.empty((len(paths), IMG_HEIGHT, IMG_WIDTH, 3), dtype=np.uint8)
 
-    for f in os.listdir(data_dir):
-        path = os.path.join(data_dir, f)
-        if os.path.isdir(path):
-            print(f"Loading {path}!")
-            for file in os.listdir(path):
-                try:
-                    image = cv2.imread(os.path.join(path, file), cv2.IMREAD_COLOR)
-                    image = cv2.resize(image, (IMG_WIDTH, IMG_HEIGHT), interpolation = cv2.INTER_AREA)
-                    images.append(image)
-                    labels.append(int(f))
-                except Exception as e:
-                    print(str(e))
+    print(f"Loading {len(paths)} images from {data_dir}!")
+    loaded = decode_images(paths, images, workers=workers)
 
+    labels = np.array(labels, dtype=np.int64)
+    if not loaded.all():
+        images, labels = images[loaded], labels[loaded]
     return images, labels
 
 
-def get_model():
+def calibration_images(data_dir, n, workers=None):
+    """
+    Return a uint8 array of up to `n` images drawn at random from across
+    every category of `data_dir`, decoding only those images.
+    """
+    paths = list_images(data_dir)[0]
+    chosen = np.random.default_rng().choice(
+        len(paths), size=min(n, len(paths)), replace=False
+    )
+    paths = [paths[i] for i in chosen]
+    images = np.empty((len(paths), IMG_HEIGHT, IMG_WIDTH, 3), dtype=np.uint8)
+    loaded = decode_images(paths, images, workers=workers)
+    return images[loaded]
+
+
+def decode_images(paths, images, workers=None):
+    """
+    Decode and resize the images at `paths` into the matching rows of the
+    preallocated uint8 array `images`, using a pool of `workers` threads.
+    Return a boolean array marking which images could be read.
+    """
+    loaded = np.zeros(len(paths), dtype=bool)
+
+    def load(i):
+        try:
+            images[i] = read_image(paths[i])
+            loaded[i] = True
+        except Exception as e:
+            print(str(e))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(load, range(len(paths))):
+            pass
+    return loaded
+
+
+def cache_key(data_dir):
+    """
+    Return a string identifying the image files in `data_dir`, by their
+    paths, sizes and modification times, and the target image size.
+    """
+    digest = hashlib.sha1()
+    for path in list_images(data_dir)[0]:
+        stat = os.stat(path)
+        relative = os.path.relpath(path, data_dir)
+        digest.update(f"{relative}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return f"{digest.hexdigest()}-{IMG_WIDTH}x{IMG_HEIGHT}"
+
+
+def load_cache(data_dir, cache_dir, workers=None):
+    """
+    Return tuple `(images, labels)` for `data_dir` from a preprocessed
+    cache in `cache_dir`, creating the cache first if there is none for the
+    current contents of `data_dir` and image size.
+
+    `images` is a read-only uint8 array memory-mapped from `images.npy`,
+    and `labels` an int64 array in which images that could not be read
+    have label -1, so neither ever needs to be compacted or copied.
+    """
+    directory = os.path.join(cache_dir, cache_key(data_dir))
+    images_file = os.path.join(directory, "images.npy")
+    labels_file = os.path.join(directory, "labels.npy")
+
+    if not os.path.exists(labels_file):
+        paths, labels = list_images(data_dir)
+        os.makedirs(directory, exist_ok=True)
+        print(f"Caching {len(paths)} images from {data_dir} in {directory}!")
+        images = np.lib.format.open_memmap(
+            images_file, mode="w+", dtype=np.uint8,
+            shape=(len(paths), IMG_HEIGHT, IMG_WIDTH, 3)
+        )
+        loaded = decode_images(paths, images, workers=workers)
+        images.flush()
+        del images
+
+        # Labels are written last, marking the cache as complete
+        labels = np.where(loaded, np.array(labels, dtype=np.int64), -1)
+        np.save(labels_file, labels)
+
+    return np.load(images_file, mmap_mode="r"), np.load(labels_file)
+
+
+def index_dataset(images, labels, indices, batch_size, shuffle=False,
+                  seed=None):
+    """
+    Return a batched `tf.data.Dataset` of `(images, one-hot labels)` that
+    gathers each batch from `images` (which may be memory-mapped) by
+    position in `indices`, so a train/test split never copies the images.
+    If `shuffle` is True, the order is reshuffled each epoch from `seed`.
+    """
+    def gather(batch):
+        batch = np.sort(batch)
+        return images[batch], labels[batch]
+
+    def load(batch):
+        x, y = tf.numpy_function(gather, [batch], (tf.uint8, tf.int64))
+        x.set_shape((None, IMG_HEIGHT, IMG_WIDTH, 3))
+        y.set_shape((None,))
+        return x, tf.one_hot(y, NUM_CATEGORIES)
+
+    dataset = tf.data.Dataset.from_tensor_slices(indices)
+    if shuffle:
+        dataset = dataset.shuffle(
+            len(indices), seed=seed, reshuffle_each_iteration=True
+        )
+    return dataset.batch(batch_size).map(
+        load, num_parallel_calls=tf.data.AUTOTUNE
+    ).prefetch(tf.data.AUTOTUNE)
+
+
+def make_dataset(paths, labels, batch_size, shuffle=False, seed=None):
+    """
+    Return a batched `tf.data.Dataset` of `(image, one-hot label)` pairs
+    that decodes and resizes the images at `paths` in parallel as they are
+    needed, and prefetches batches so training overlaps with loading.
+    Decoded images are cached after the first epoch, and shuffled through a
+    buffer of at most SHUFFLE_BUFFER images so that only one copy of the
+    data set is held in memory, reshuffled each epoch from `seed`; images
+    that cannot be read are skipped.
+    """
+    def decode(path):
+        image = tf.numpy_function(
+            lambda p: read_image(p.decode()), [path], tf.uint8
+        )
+        image.set_shape((IMG_HEIGHT, IMG_WIDTH, 3))
+        return image
+
+    images = tf.data.Dataset.from_tensor_slices(paths).map(
+        decode, num_parallel_calls=tf.data.AUTOTUNE
+    )
+    labels = tf.data.Dataset.from_tensor_slices(
+        tf.one_hot(labels, NUM_CATEGORIES)
+    )
+    dataset = tf.data.Dataset.zip((images, labels)).ignore_errors().cache()
+    if shuffle:
+        dataset = dataset.shuffle(
+            SHUFFLE_BUFFER, seed=seed, reshuffle_each_iteration=True
+        )
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def augment_dataset(dataset, seed):
+    """
+    Return batched `dataset` of `(images, labels)` with every batch of
+    images randomly augmented by `augment_images`, in parallel and with
+    prefetching. Augmentations differ from epoch to epoch but are fully
+    determined by `seed`.
+    """
+    seeds = tf.data.Dataset.random(
+        seed=seed, rerandomize_each_iteration=True
+    ).batch(2)
+
+    def augment(batch, batch_seed):
+        images, labels = batch
+        return augment_images(images, batch_seed), labels
+
+    return tf.data.Dataset.zip((dataset, seeds)).map(
+        augment, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True
+    ).prefetch(tf.data.AUTOTUNE)
+
+
+def augment_images(images, seed):
+    """
+    Randomly augment a batch of `images` with vectorized tensor ops: an
+    affine transform (rotation, scaling and translation), brightness and
+    contrast changes, and a Gaussian blur for some images. `seed` is a
+    shape (2,) integer tensor from which all randomness is derived.
+    Return float32 images with pixel values from 0 to 255.
+    """
+    images = tf.cast(images, tf.float32)
+    n = tf.shape(images)[0]
+    seeds = tf.random.experimental.stateless_split(tf.cast(seed, tf.int64), 7)
+
+    def uniform(i, low, high):
+        return tf.random.stateless_uniform((n,), seeds[i], low, high)
+
+    # Affine transforms about the image center, as the projective
+    # transforms mapping each output pixel back to an input pixel
+    angle = uniform(0, -AUGMENT_ROTATION, AUGMENT_ROTATION)
+    scale = uniform(1, 1 - AUGMENT_SCALE, 1 + AUGMENT_SCALE)
+    dx = uniform(2, -AUGMENT_SHIFT, AUGMENT_SHIFT)
+    dy = uniform(3, -AUGMENT_SHIFT, AUGMENT_SHIFT)
+    cx, cy = (IMG_WIDTH - 1) / 2, (IMG_HEIGHT - 1) / 2
+    a0 = tf.cos(angle) / scale
+    a1 = tf.sin(angle) / scale
+    b0 = -a1
+    b1 = a0
+    a2 = cx - a0 * (cx + dx) - a1 * (cy + dy)
+    b2 = cy - b0 * (cx + dx) - b1 * (cy + dy)
+    zeros = tf.zeros_like(angle)
+    transforms = tf.stack([a0, a1, a2, b0, b1, b2, zeros, zeros], axis=1)
+    images = tf.raw_ops.ImageProjectiveTransformV3(
+        images=images, transforms=transforms,
+        output_shape=tf.constant((IMG_HEIGHT, IMG_WIDTH)),
+        fill_value=0.0, interpolation="BILINEAR", fill_mode="REFLECT"
+    )
+
+    # Brightness and contrast, per image
+    brightness = uniform(4, -AUGMENT_BRIGHTNESS, AUGMENT_BRIGHTNESS)
+    contrast = uniform(5, 1 - AUGMENT_CONTRAST, 1 + AUGMENT_CONTRAST)
+    mean = tf.reduce_mean(images, axis=(1, 2, 3), keepdims=True)
+    images = (images - mean) * contrast[:, None, None, None] + mean
+    images = images + brightness[:, None, None, None]
+
+    # Gaussian blur as one depthwise convolution, kept for some images
+    kernel = tf.constant([1.0, 2.0, 1.0])
+    kernel = tf.tensordot(kernel, kernel, axes=0) / 16
+    kernel = tf.tile(kernel[:, :, None, None], (1, 1, 3, 1))
+    blurred = tf.nn.depthwise_conv2d(images, kernel, (1, 1, 1, 1), "SAME")
+    blur = uniform(6, 0, 1) < AUGMENT_BLUR
+    images = tf.where(blur[:, None, None, None], blurred, images)
+
+    return tf.clip_by_value(images, 0, 255)
+
+
+def augmentation_throughput(dataset, seed):
+    """
+    Measure augmentation speed on batched `dataset`, and return a tuple
+    (augmented, plain, pipelined) of images per second: `augment_images`
+    alone over batches already in memory, then full passes of `dataset`
+    without and with `augment_dataset`. When `dataset` streams from disk,
+    both pipeline passes include decoding, so only their difference and
+    the in-memory figure reflect augmentation.
+    """
+    batches = [images for images, _ in dataset]
+    count = sum(int(images.shape[0]) for images in batches)
+    augment = tf.function(augment_images)
+    seeds = tf.random.experimental.stateless_split(
+        tf.constant((seed, 0), tf.int64), len(batches)
+    )
+    augment(batches[0], seeds[0])
+    augment(batches[-1], seeds[-1])
+
+    start = time.perf_counter()
+    for images, batch_seed in zip(batches, seeds):
+        augment(images, batch_seed)
+    augmented = count / (time.perf_counter() - start)
+
+    rates = []
+    for pipeline in (dataset, augment_dataset(dataset, seed)):
+        start = time.perf_counter()
+        for _ in pipeline:
+            pass
+        rates.append(count / (time.perf_counter() - start))
+    return (augmented, *rates)
+
+
+def get_model(architecture="baseline", jit_compile=False):
     """
     Returns a compiled convolutional neural network model. Assume that the
     `input_shape` of the first layer is `(IMG_WIDTH, IMG_HEIGHT, 3)`.
     The output layer should have `NUM_CATEGORIES` units, one for each category.
+
+    `architecture` is one of ARCHITECTURES: "baseline" flattens a single
+    convolution into three large dense layers; "compact" and "tiny" stack
+    depthwise-separable convolutions and global average pooling under a
+    single dense output layer, for a small fraction of the parameters and
+    multiply-accumulates (see `model_report`). If `jit_compile` is True,
+    training and inference steps are compiled with XLA.
+
+    The output layer always computes in float32, so the model stays
+    numerically stable under a mixed precision policy.
     """
-   
-    model = tf.keras.models.Sequential([
-        tf.keras.layers.Conv2D(
-            32, (3, 3), activation="relu", input_shape=(IMG_WIDTH, IMG_HEIGHT, 3)
-        ),
+    if architecture not in ARCHITECTURES:
+        raise ValueError(f"Unknown architecture {architecture}")
+    model = tf.keras.models.Sequential(
+        [tf.keras.Input(shape=(IMG_WIDTH, IMG_HEIGHT, 3))] +
+        ARCHITECTURES[architecture]()
+    )
+
+    # train
+    model.compile(
+        optimizer = "adam",
+        loss = "categorical_crossentropy",
+        metrics = ["accuracy"],
+        jit_compile = jit_compile
+    )
+
+    return model
+
+
+def baseline_layers():
+    """
+    Return the layers of the original model: one convolution flattened
+    into three large dense layers.
+    """
+    return [
+        tf.keras.layers.Conv2D(32, (3, 3), activation="relu"),
         tf.keras.layers.MaxPooling2D(pool_size=(3, 3)),
         tf.keras.layers.Flatten(),
         tf.keras.layers.Dropout(0.2),
@@ -94,17 +547,298 @@ def get_model():
         tf.keras.layers.Dropout(0.2),
         tf.keras.layers.Dense(NUM_CATEGORIES * 16, activation="relu"),
         tf.keras.layers.Dense(NUM_CATEGORIES * 8, activation="relu"),
-        tf.keras.layers.Dense(NUM_CATEGORIES, activation="softmax")
+        tf.keras.layers.Dense(NUM_CATEGORIES, activation="softmax", dtype="float32")
+    ]
+
+
+def separable_layers(widths):
+    """
+    Return the layers of a compact model: a strided full convolution with
+    `widths[0]` filters, then a depthwise-separable convolution for each of
+    the remaining `widths`, downsampling between them, and global average
+    pooling into the output layer.
+    """
+    layers = [
+        tf.keras.layers.Rescaling(1 / 255),
+        tf.keras.layers.Conv2D(
+            widths[0], (3, 3), strides=2, padding="same", use_bias=False
+        ),
+        tf.keras.layers.BatchNormalization(),
+        tf.keras.layers.ReLU()
+    ]
+    for i, width in enumerate(widths[1:]):
+        if i > 0:
+            layers.append(tf.keras.layers.MaxPooling2D(pool_size=(2, 2)))
+        layers.extend([
+            tf.keras.layers.SeparableConv2D(
+                width, (3, 3), padding="same", use_bias=False
+            ),
+            tf.keras.layers.BatchNormalization(),
+            tf.keras.layers.ReLU()
+        ])
+    layers.extend([
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dropout(0.2),
+        tf.keras.layers.Dense(NUM_CATEGORIES, activation="softmax", dtype="float32")
     ])
+    return layers
 
-    # train
-    model.compile(
-        optimizer = "adam",
-        loss = "categorical_crossentropy",
-        metrics = ["accuracy"]
+
+# Maps names of model architectures to functions returning their layers
+ARCHITECTURES = {
+    "baseline": baseline_layers,
+    "compact": lambda: separable_layers([32, 64, 128, 128]),
+    "tiny": lambda: separable_layers([16, 32, 64, 64])
+}
+
+
+def model_report(model):
+    """
+    Return a list of tuples `(layer name, parameters, MACs)` for each layer
+    of `model` with parameters, where MACs are the multiply-accumulates the
+    layer performs to classify one image.
+    """
+    report = []
+    for layer in model.layers:
+        params = layer.count_params()
+        if not params:
+            continue
+        out = layer.output.shape
+        channels = layer.input.shape[-1]
+        if isinstance(layer, tf.keras.layers.SeparableConv2D):
+            kh, kw = layer.kernel_size
+            depthwise = kh * kw * channels * layer.depth_multiplier
+            pointwise = channels * layer.depth_multiplier * layer.filters
+            macs = out[1] * out[2] * (depthwise + pointwise)
+        elif isinstance(layer, tf.keras.layers.Conv2D):
+            kh, kw = layer.kernel_size
+            macs = out[1] * out[2] * kh * kw * channels * layer.filters
+        elif isinstance(layer, tf.keras.layers.Dense):
+            macs = channels * layer.units
+        else:
+            macs = int(np.prod(out[1:]))
+        report.append((layer.name, params, macs))
+    return report
+
+
+def report_main():
+    """
+    Print the parameters and MACs of every architecture `get_model` offers,
+    as in `python traffic.py report`.
+    """
+    for architecture in ARCHITECTURES:
+        report = model_report(get_model(architecture))
+        print(f"{architecture}:")
+        for name, params, macs in report:
+            print(f"  {name:<32}{params:>12,} params{macs:>14,} MACs")
+        params = sum(r[1] for r in report)
+        macs = sum(r[2] for r in report)
+        print(f"  {'total':<32}{params:>12,} params{macs:>14,} MACs")
+
+
+class EpochTimer(tf.keras.callbacks.Callback):
+    """
+    Prints the wall-clock time of each epoch and its training throughput
+    over `images` training images, and keeps each epoch's time in `times`.
+    """
+
+    def __init__(self, images):
+        super().__init__()
+        self.images = images
+        self.times = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = time.perf_counter() - self.start
+        self.times.append(elapsed)
+        print(
+            f"Epoch {epoch + 1} took {elapsed:.2f}s "
+            f"({self.images / elapsed:.0f} images/sec)"
+        )
+
+
+class ProfileBatches(tf.keras.callbacks.Callback):
+    """
+    Writes a TensorFlow profiler trace of training batches `first` through
+    `last` of the first epoch to `log_dir`, viewable in TensorBoard.
+    """
+
+    def __init__(self, log_dir, first, last):
+        super().__init__()
+        self.log_dir = log_dir
+        self.first = first
+        self.last = last
+        self.running = False
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if batch == self.first and not self.running:
+            tf.profiler.experimental.start(self.log_dir)
+            self.running = True
+
+    def on_train_batch_end(self, batch, logs=None):
+        if batch == self.last and self.running:
+            self.stop()
+
+    def on_train_end(self, logs=None):
+        if self.running:
+            self.stop()
+
+    def stop(self):
+        tf.profiler.experimental.stop()
+        self.running = False
+        self.first = -1
+        print(f"Profiler trace written to {self.log_dir}.")
+
+
+def predict_main(argv):
+    """
+    Classify images with a saved model, as in
+    `python traffic.py predict model.h5 images...`, printing the predicted
+    category of each image and then throughput and latency statistics.
+    """
+    parser = argparse.ArgumentParser(prog="python traffic.py predict")
+    parser.add_argument("model")
+    parser.add_argument(
+        "inputs", nargs="+",
+        help="image files or category-style directories of them, or - to "
+             "read image paths from standard input"
+    )
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument(
+        "--threads", type=int, default=None,
+        help="number of CPU threads to run inference and decoding with"
+    )
+    parser.add_argument(
+        "--tflite", action="store_true",
+        help="convert the model to TensorFlow Lite and run it with the "
+             "TensorFlow Lite interpreter"
+    )
+    parser.add_argument(
+        "--quantize", metavar="DATA_DIRECTORY",
+        help="quantize weights and activations to int8 after training, "
+             "calibrated on images from this directory (implies --tflite)"
     )
+    args = parser.parse_args(argv)
 
-    return model
+    if args.threads:
+        tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+        tf.config.threading.set_inter_op_parallelism_threads(args.threads)
+
+    model = tf.keras.models.load_model(args.model)
+    if args.tflite or args.quantize:
+        representative = None
+        if args.quantize:
+            representative = calibration_images(
+                args.quantize, QUANTIZATION_SAMPLES, workers=args.threads
+            )
+        classify = TFLiteClassifier(
+            model, threads=args.threads, representative=representative
+        )
+    else:
+        classify = lambda batch: model(batch, training=False).numpy()
+
+    latencies = []
+    count = 0
+    for paths, batch in image_batches(args.inputs, args.batch_size, args.threads):
+
+        # Keep one-off tracing and allocation out of the latency figures
+        if not latencies:
+            classify(batch)
+
+        start = time.perf_counter()
+        probabilities = classify(batch)
+        latencies.append(time.perf_counter() - start)
+        count += len(batch)
+        for path, p in zip(paths, probabilities):
+            print(f"{path}\t{int(np.argmax(p))}\t{float(np.max(p)):.4f}")
+
+    if count:
+        total = sum(latencies)
+        print(
+            f"{count} images in {len(latencies)} batches: "
+            f"{count / total:.1f} images/sec, "
+            f"p50 {1000 * np.percentile(latencies, 50):.2f} ms, "
+            f"p99 {1000 * np.percentile(latencies, 99):.2f} ms per batch",
+            file=sys.stderr
+        )
+
+
+def image_paths(inputs):
+    """
+    Yield the path of every image named by `inputs`: image files, category
+    directories like those `load_data` reads, or "-" for paths read one
+    per line from standard input.
+    """
+    for name in inputs:
+        if name == "-":
+            for line in sys.stdin:
+                if line.strip():
+                    yield line.strip()
+        elif os.path.isdir(name):
+            for f in sorted(os.listdir(name)):
+                path = os.path.join(name, f)
+                if os.path.isdir(path):
+                    yield from (os.path.join(path, g) for g in sorted(os.listdir(path)))
+                else:
+                    yield path
+        else:
+            yield name
+
+
+def image_batches(inputs, batch_size, workers=None):
+    """
+    Yield tuples `(paths, images)` of batches of up to `batch_size` images
+    named by `inputs`, decoded in parallel; unreadable images are skipped.
+    """
+    paths = image_paths(inputs)
+    while True:
+        chunk = [path for _, path in zip(range(batch_size), paths)]
+        if not chunk:
+            return
+        images = np.empty((len(chunk), IMG_HEIGHT, IMG_WIDTH, 3), dtype=np.uint8)
+        loaded = decode_images(chunk, images, workers=workers)
+        if loaded.any():
+            yield [p for p, ok in zip(chunk, loaded) if ok], images[loaded]
+
+
+class TFLiteClassifier():
+    """
+    Runs a Keras model through the TensorFlow Lite interpreter on CPU.
+
+    If `representative` images are given, the model is converted with
+    post-training int8 quantization of weights and activations, calibrated
+    on them; inputs and outputs stay float, quantized inside the model.
+    """
+
+    def __init__(self, model, threads=None, representative=None):
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        if representative is not None:
+            def samples():
+                for image in representative[:QUANTIZATION_SAMPLES]:
+                    yield [image[np.newaxis].astype(np.float32)]
+
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = samples
+            converter.target_spec.supported_ops = [
+                tf.lite.OpsSet.TFLITE_BUILTINS_INT8
+            ]
+        self.interpreter = tf.lite.Interpreter(
+            model_content=converter.convert(), num_threads=threads
+        )
+        self.input = self.interpreter.get_input_details()[0]["index"]
+        self.output = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = None
+
+    def __call__(self, batch):
+        if len(batch) != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input, batch.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(batch)
+        self.interpreter.set_tensor(self.input, batch.astype(np.float32))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output)
 
 
 if __name__ == "__main__":